@@ -0,0 +1,51 @@
+import datetime
+import random
+
+STUDENTS = ["Abhisar Anand", "Jordan Lee", "Priya Patel", "Sam Rivera"]
+COURSES = ["MA 16600-03", "MA 17500-02", "CS 18000-01", "PHYS 17200-05", "ENGL 10600-12", "STAT 35000-04"]
+TASK_TYPES = ["Homework Quiz", "Quiz", "Lab Report", "Problem Set", "Reading Response", "Project Milestone"]
+TIME_ZONES = ["EDT", "EST"]
+NOISE_LINES = [
+    "You have new activity in your courses.",
+    "Announcements",
+    "There are no new announcements for this course.",
+    "View all course activity<https://purdue.brightspace.com/d2l/home>",
+    "Discussions",
+    "2 unread posts in Week 7 discussion<https://purdue.brightspace.com/d2l/le/discussions>",
+    "",
+    "To change your notification settings, go to Notifications in Brightspace.",
+]
+
+
+def build_activity_summary(rng, course, assignment_count, forwarded=False, noise_lines=20, start=None):
+    """Builds one synthetic text/plain Brightspace "Activity summary" digest and its expected assignments"""
+    student = rng.choice(STUDENTS)
+    course_code = course.replace(" ", "")
+    lines = []
+    if forwarded:
+        lines.append(f"FW: Activity summary for {student} in {course} - Brightspace")
+        lines.append("")
+    lines.append(f"Activity summary for {student} in {course} - Brightspace")
+    lines.extend(rng.choice(NOISE_LINES) for _ in range(noise_lines // 2))
+    lines.append("Assignments")
+
+    expected = []
+    start = start or datetime.datetime(2024, 1, 8, 9, 0)
+    for _ in range(assignment_count):
+        task_name = f"{rng.choice(TASK_TYPES)} #{rng.randint(1, 40)}"
+        due_date = start + datetime.timedelta(days=rng.randint(0, 120), hours=rng.randint(0, 14), minutes=rng.choice([0, 15, 30, 59]))
+        lines.append(f"{task_name}<https://purdue.brightspace.com/d2l/lms/dropbox/{rng.randint(1000, 99999)}> - Due date is in {rng.randint(1, 9)} days")
+        lines.append(f": Due date: {due_date.strftime('%A, %B %d, %Y %I:%M %p').replace(' 0', ' ')} {rng.choice(TIME_ZONES)}")
+        expected.append((task_name, course_code, due_date))
+
+    lines.extend(rng.choice(NOISE_LINES) for _ in range(noise_lines - noise_lines // 2))
+    return "\n".join(lines) + "\n", expected
+
+
+def build_corpus(email_count=1000, seed=7):
+    """Returns a deterministic list of (body, expected assignments) pairs"""
+    rng = random.Random(seed)
+    return [
+        build_activity_summary(rng, rng.choice(COURSES), rng.randint(0, 8), forwarded=rng.random() < 0.3, noise_lines=rng.randint(5, 60))
+        for _ in range(email_count)
+    ]
@@ -0,0 +1,150 @@
+import argparse
+import collections
+import contextlib
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+from google.auth.credentials import AnonymousCredentials
+from googleapiclient.discovery import build
+from Benchmarks.FakeServers import SENDER, FakeBackend, FakeServer
+from Common.Pipeline import SyncPipeline
+from Google.GCalendarTasks import GCalendarTasks
+from Google.GmailReader import GmailReader
+from Todoist.TodoistTasks import TodoistTasks
+
+
+class StageRecorder:
+    def __init__(self, backend):
+        self.backend = backend
+        self.stages = []
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        calls_before = collections.Counter(self.backend.calls)
+        tracemalloc.reset_peak()
+        start = time.perf_counter()
+        yield
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        calls = collections.Counter(self.backend.calls)
+        calls.subtract(calls_before)
+        self.stages.append({
+            'stage': name,
+            'seconds': round(elapsed, 4),
+            'peak_memory_mb': round(peak / (1024 * 1024), 2),
+            'api_calls': {endpoint: count for endpoint, count in sorted(calls.items()) if count},
+        })
+
+    def print_report(self):
+        print(f"{'Stage':<20}{'Seconds':>10}{'Peak MB':>10}  API calls")
+        for stage in self.stages:
+            calls = ', '.join(f"{endpoint}={count}" for endpoint, count in stage['api_calls'].items()) or '-'
+            print(f"{stage['stage']:<20}{stage['seconds']:>10.3f}{stage['peak_memory_mb']:>10.2f}  {calls}")
+
+
+def google_service(name, version, server_url):
+    return build(name, version, credentials=AnonymousCredentials(), client_options={'api_endpoint': server_url + '/'}, static_discovery=True)
+
+
+def make_reader(server_url, workdir):
+    reader = GmailReader(state_path=os.path.join(workdir, 'gmail_sync_state.json'), use_cache=False)
+    reader.service = google_service('gmail', 'v1', server_url)
+    reader.batch_uri = server_url + '/batch/gmail/v1'
+    return reader
+
+
+def make_google_tasks(server_url, workdir, run):
+    calendar_tasks = GCalendarTasks(
+        {},
+        log_file_path=os.path.join(workdir, f'gTasks_ledger_{run}.jsonl'),
+        legacy_log_file_path=os.path.join(workdir, 'missing_legacy_log.json'),
+        remote_state_path=os.path.join(workdir, f'gTasks_remote_{run}.json')
+    )
+    calendar_tasks.service = google_service('tasks', 'v1', server_url)
+    calendar_tasks.batch_uri = server_url + '/batch/tasks/v1'
+    return calendar_tasks
+
+
+def make_todoist(server_url, workdir, run):
+    todoist_tasks = TodoistTasks(
+        {},
+        log_file_path=os.path.join(workdir, f'todoist_ledger_{run}.jsonl'),
+        legacy_log_file_path=os.path.join(workdir, 'missing_legacy_log.json'),
+        sync_url=server_url + '/api/v1/sync',
+        ids_cache_path=os.path.join(workdir, 'todoist_ids_cache.json'),
+        api_token='benchmark'
+    )
+    # The Todoist REST SDK has no endpoint override, so id resolution is taken as already cached
+    todoist_tasks.project_id, todoist_tasks.section_id = 'p1', 's1'
+    return todoist_tasks
+
+
+def run_benchmark(args):
+    backend = FakeBackend(
+        mailbox_size=args.mailbox_size,
+        digest_ratio=args.digest_ratio,
+        latency=args.latency_ms / 1000,
+        rate_limits={service: rate for service, rate in (('gmail', args.gmail_rate), ('tasks', args.tasks_rate), ('todoist', args.todoist_rate)) if rate},
+        page_size=args.page_size
+    )
+    recorder = StageRecorder(backend)
+
+    tracemalloc.start()
+    with FakeServer(backend) as server, tempfile.TemporaryDirectory() as workdir:
+        reader = make_reader(server.url, workdir)
+        with recorder.stage('gmail.fetch'):
+            emails = list(reader.stream_messages(SENDER))
+        with recorder.stage('parse'):
+            assignments = list(reader.iter_assignments(emails))
+        with recorder.stage('google_tasks.sync'):
+            make_google_tasks(server.url, workdir, 'staged').sync_stream(iter(assignments))
+        with recorder.stage('todoist.sync'):
+            make_todoist(server.url, workdir, 'staged').sync_stream(iter(assignments))
+
+        # The same work end to end, with the sinks consuming while Gmail is still being read.
+        # The sinks start from empty task lists again, so both runs create the same tasks.
+        backend.google_tasks.clear()
+        backend.todoist_items.clear()
+        reader = make_reader(server.url, workdir)
+        sinks = {
+            'Google Tasks': make_google_tasks(server.url, workdir, 'pipeline'),
+            'Todoist': make_todoist(server.url, workdir, 'pipeline'),
+        }
+        with recorder.stage('pipeline'):
+            SyncPipeline(sinks).run(reader.iter_assignments(reader.stream_messages(SENDER)))
+    tracemalloc.stop()
+
+    return {
+        'mailbox_size': args.mailbox_size,
+        'digest_ratio': args.digest_ratio,
+        'latency_ms': args.latency_ms,
+        'emails': len(emails),
+        'assignments': len(assignments),
+        'stages': recorder.stages,
+    }, recorder
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end benchmark against local stand-ins for Gmail, Google Tasks and Todoist")
+    parser.add_argument('--mailbox-size', type=int, default=500)
+    parser.add_argument('--digest-ratio', type=float, default=1.0, help="share of messages that are Activity summary digests")
+    parser.add_argument('--latency-ms', type=float, default=20.0, help="latency added to every HTTP round trip")
+    parser.add_argument('--page-size', type=int, default=100, help="messages.list page size")
+    parser.add_argument('--gmail-rate', type=float, default=0, help="Gmail requests per second before 429s (0 = unlimited)")
+    parser.add_argument('--tasks-rate', type=float, default=0, help="Google Tasks requests per second before 429s (0 = unlimited)")
+    parser.add_argument('--todoist-rate', type=float, default=0, help="Todoist requests per second before 429s (0 = unlimited)")
+    parser.add_argument('--json', help="also write the report to this file")
+    args = parser.parse_args()
+
+    report, recorder = run_benchmark(args)
+    print(f"Mailbox: {report['emails']} emails, {report['assignments']} assignments, {args.latency_ms:g} ms latency")
+    recorder.print_report()
+    if args.json:
+        with open(args.json, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
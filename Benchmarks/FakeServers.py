@@ -0,0 +1,390 @@
+import base64
+import collections
+import datetime
+import email.parser
+import itertools
+import json
+import random
+import re
+import threading
+import time
+import urllib.parse
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from Benchmarks.Corpus import COURSES, build_activity_summary
+
+SENDER = "student@example.edu"
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def try_take(self, cost=1):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < cost:
+            return False
+        self.tokens -= cost
+        return True
+
+
+class FakeBackend:
+    """In-memory stand-in for the Gmail, Google Tasks and Todoist endpoints the sync code calls.
+
+    latency is added to every HTTP round trip; rate_limits maps 'gmail', 'tasks' or 'todoist' to
+    requests per second, above which calls are answered with 429 and a Retry-After header.
+    """
+
+    def __init__(self, mailbox_size=500, digest_ratio=1.0, latency=0.0, rate_limits=None, page_size=100, seed=7):
+        self.lock = threading.Lock()
+        self.latency = latency
+        self.page_size = page_size
+        self.rate_limits = {service: TokenBucket(rate) for service, rate in (rate_limits or {}).items()}
+        self.calls = collections.Counter()
+        self.rng = random.Random(seed)
+        self.ids = itertools.count(1)
+
+        self.messages = {}
+        self.message_order = []  # newest first, like messages.list
+        self.history_id = 1000
+        self.oldest_history_id = self.history_id
+        self.add_messages(mailbox_size, digest_ratio)
+
+        self.google_tasks = {}
+        self.todoist_projects = [{'id': 'p1', 'name': 'ToDo'}]
+        self.todoist_sections = [{'id': 's1', 'project_id': 'p1', 'name': 'Abhisar'}]
+        self.todoist_items = {}
+
+    # --- Mailbox -------------------------------------------------------------------------------
+
+    def add_messages(self, count, digest_ratio=1.0):
+        # Due dates start tomorrow so the sinks do not skip them as past due
+        start = datetime.datetime.now().replace(hour=9, minute=0, second=0, microsecond=0) + datetime.timedelta(days=1)
+        with self.lock:
+            for _ in range(count):
+                is_digest = self.rng.random() < digest_ratio
+                if is_digest:
+                    body, _ = build_activity_summary(self.rng, self.rng.choice(COURSES), self.rng.randint(0, 8), forwarded=True, start=start)
+                    subject = "FW: Activity summary"
+                else:
+                    body = "Reminder about office hours this week.\n" * self.rng.randint(5, 200)
+                    subject = "FW: Course announcement"
+                self.history_id += 1
+                message_id = f"{next(self.ids):016x}"
+                self.messages[message_id] = self.build_message(message_id, subject, body)
+                self.message_order.insert(0, message_id)
+
+    def build_message(self, message_id, subject, body):
+        encoded = base64.urlsafe_b64encode(body.encode('utf-8')).decode('ascii')
+        html = base64.urlsafe_b64encode(f"<html><body><pre>{body}</pre></body></html>".encode('utf-8')).decode('ascii')
+        return {
+            'id': message_id,
+            'threadId': message_id,
+            'labelIds': ['INBOX'],
+            'snippet': body[:200],
+            'historyId': str(self.history_id),
+            'internalDate': str(int(time.time() * 1000)),
+            'payload': {
+                'mimeType': 'multipart/alternative',
+                'headers': [
+                    {'name': 'From', 'value': f"Student <{SENDER}>"},
+                    {'name': 'To', 'value': SENDER},
+                    {'name': 'Subject', 'value': subject},
+                ],
+                'body': {'size': 0},
+                'parts': [
+                    {'partId': '0', 'mimeType': 'text/plain', 'headers': [], 'body': {'size': len(body), 'data': encoded}},
+                    {'partId': '1', 'mimeType': 'text/html', 'headers': [], 'body': {'size': len(html), 'data': html}},
+                ],
+            },
+            'sizeEstimate': len(encoded) + len(html),
+        }
+
+    # --- HTTP plumbing -------------------------------------------------------------------------
+
+    ROUTES = [
+        ('GET', re.compile(r'/users/me/messages$'), 'gmail', 'messages.list'),
+        ('GET', re.compile(r'/users/me/messages/([^/]+)$'), 'gmail', 'messages.get'),
+        ('GET', re.compile(r'/users/me/profile$'), 'gmail', 'users.getProfile'),
+        ('GET', re.compile(r'/users/me/history$'), 'gmail', 'history.list'),
+        ('POST', re.compile(r'/batch/gmail/v1$'), 'gmail', 'batch'),
+        ('GET', re.compile(r'/lists/([^/]+)/tasks$'), 'tasks', 'tasks.list'),
+        ('POST', re.compile(r'/lists/([^/]+)/tasks$'), 'tasks', 'tasks.insert'),
+        ('PATCH', re.compile(r'/lists/([^/]+)/tasks/([^/]+)$'), 'tasks', 'tasks.patch'),
+        ('POST', re.compile(r'/batch/tasks/v1$'), 'tasks', 'batch'),
+        ('GET', re.compile(r'/api/v1/projects$'), 'todoist', 'projects.list'),
+        ('GET', re.compile(r'/api/v1/sections$'), 'todoist', 'sections.list'),
+        ('GET', re.compile(r'/api/v1/tasks$'), 'todoist', 'tasks.list'),
+        ('GET', re.compile(r'/api/v1/tasks/completed/by_completion_date$'), 'todoist', 'tasks.completed'),
+        ('POST', re.compile(r'/api/v1/tasks$'), 'todoist', 'tasks.add'),
+        ('POST', re.compile(r'/api/v1/sync$'), 'todoist', 'sync'),
+    ]
+
+    def handle_http(self, method, raw_path, headers, body):
+        if self.latency:
+            time.sleep(self.latency)
+        return self.route(method, raw_path, headers, body)
+
+    def route(self, method, raw_path, headers, body):
+        parsed = urllib.parse.urlparse(raw_path)
+        path = urllib.parse.unquote(parsed.path)
+        query = {key: values[-1] for key, values in urllib.parse.parse_qs(parsed.query).items()}
+
+        for route_method, pattern, service, endpoint in self.ROUTES:
+            match = pattern.search(path)
+            if route_method != method or not match:
+                continue
+
+            with self.lock:
+                self.calls[f"{service}.{endpoint}"] += 1
+                bucket = self.rate_limits.get(service)
+                if endpoint != 'batch' and bucket and not bucket.try_take():
+                    self.calls[f"{service}.throttled"] += 1
+                    return self.error(429, "Rate limit exceeded", 'rateLimitExceeded', {'Retry-After': '1'})
+
+            if endpoint == 'batch':
+                return self.handle_batch(headers, body)
+            handler = getattr(self, 'handle_' + f"{service}_{endpoint}".replace('.', '_'))
+            with self.lock:
+                return handler(match, query, headers, body)
+        return self.error(404, f"No fake endpoint for {method} {path}", 'notFound')
+
+    @staticmethod
+    def json_response(payload, status=200, extra_headers=None):
+        headers = {'Content-Type': 'application/json; charset=UTF-8'}
+        headers.update(extra_headers or {})
+        return status, headers, json.dumps(payload).encode('utf-8')
+
+    def error(self, status, message, reason, extra_headers=None):
+        payload = {'error': {'code': status, 'message': message, 'errors': [{'reason': reason, 'message': message}]}}
+        return self.json_response(payload, status, extra_headers)
+
+    def handle_batch(self, headers, body):
+        # Google's batch format: multipart/mixed request parts, each an application/http request
+        content_type = headers.get('Content-Type', '')
+        message = email.parser.BytesParser().parsebytes(f"Content-Type: {content_type}\r\n\r\n".encode('utf-8') + body)
+        boundary = f"batch_{uuid.uuid4().hex}"
+        response_parts = []
+        for part in message.get_payload():
+            raw_request = part.get_payload().replace('\r\n', '\n')
+            head, _, inner_body = raw_request.partition('\n\n')
+            request_line, *header_lines = head.split('\n')
+            inner_method, inner_path, _ = request_line.split(' ', 2)
+            inner_headers = dict(line.split(': ', 1) for line in header_lines if ': ' in line)
+            status, response_headers, content = self.route(inner_method, inner_path, inner_headers, inner_body.encode('utf-8'))
+
+            content_id = part['Content-ID'].strip('<>')
+            response_parts.append(
+                f"--{boundary}\r\nContent-Type: application/http\r\nContent-ID: <response-{content_id}>\r\n\r\n"
+                f"HTTP/1.1 {status} {'OK' if status < 300 else 'Error'}\r\n"
+                + ''.join(f"{name}: {value}\r\n" for name, value in response_headers.items())
+                + f"\r\n{content.decode('utf-8')}\r\n"
+            )
+        payload = (''.join(response_parts) + f"--{boundary}--\r\n").encode('utf-8')
+        return 200, {'Content-Type': f'multipart/mixed; boundary={boundary}'}, payload
+
+    # --- Gmail ---------------------------------------------------------------------------------
+
+    def page(self, items, query, default_size):
+        start = int(query.get('pageToken') or 0)
+        size = int(query.get('maxResults') or default_size)
+        next_token = str(start + size) if start + size < len(items) else None
+        return items[start:start + size], next_token
+
+    def handle_gmail_messages_list(self, match, query, headers, body):
+        message_ids, next_token = self.page(self.message_order, query, self.page_size)
+        payload = {'messages': [{'id': message_id, 'threadId': message_id} for message_id in message_ids], 'resultSizeEstimate': len(self.message_order)}
+        if next_token:
+            payload['nextPageToken'] = next_token
+        return self.json_response(payload)
+
+    def handle_gmail_messages_get(self, match, query, headers, body):
+        message = self.messages.get(match.group(1))
+        if message is None:
+            return self.error(404, "Requested entity was not found.", 'notFound')
+        if 'parts(' in query.get('fields', ''):
+            # Like a partial response, drop parts nested deeper than the field mask reaches
+            message = dict(message, payload=self.prune_parts(message['payload'], query['fields'].count('parts(')))
+        if query.get('format') == 'metadata':
+            wanted = set(query.get('metadataHeaders', '').lower().split(',')) - {''}
+            message = dict(message, payload={
+                'mimeType': message['payload']['mimeType'],
+                'headers': [header for header in message['payload']['headers'] if not wanted or header['name'].lower() in wanted],
+            })
+        return self.json_response(message)
+
+    def prune_parts(self, part, depth):
+        if 'parts' not in part:
+            return part
+        if depth == 0:
+            return {key: value for key, value in part.items() if key != 'parts'}
+        return dict(part, parts=[self.prune_parts(child, depth - 1) for child in part['parts']])
+
+    def handle_gmail_users_getProfile(self, match, query, headers, body):
+        return self.json_response({'emailAddress': SENDER, 'messagesTotal': len(self.messages), 'historyId': str(self.history_id)})
+
+    def handle_gmail_history_list(self, match, query, headers, body):
+        start_history_id = int(query['startHistoryId'])
+        if start_history_id < self.oldest_history_id:
+            return self.error(404, "Requested entity was not found.", 'notFound')
+        added = [
+            {'id': message['historyId'], 'messagesAdded': [{'message': {'id': message['id'], 'labelIds': message['labelIds']}}]}
+            for message in (self.messages[message_id] for message_id in reversed(self.message_order))
+            if int(message['historyId']) > start_history_id
+        ]
+        records, next_token = self.page(added, query, self.page_size)
+        payload = {'history': records, 'historyId': str(self.history_id)}
+        if next_token:
+            payload['nextPageToken'] = next_token
+        return self.json_response(payload)
+
+    # --- Google Tasks --------------------------------------------------------------------------
+
+    @staticmethod
+    def rfc3339_now():
+        return datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
+
+    def handle_tasks_tasks_list(self, match, query, headers, body):
+        updated_min = query.get('updatedMin')
+        tasks = [task for task in self.google_tasks.values() if not updated_min or task['updated'] >= updated_min]
+        items, next_token = self.page(tasks, query, 20)
+        payload = {'kind': 'tasks#tasks', 'items': items}
+        if next_token:
+            payload['nextPageToken'] = next_token
+        return self.json_response(payload)
+
+    def handle_tasks_tasks_insert(self, match, query, headers, body):
+        task = json.loads(body or b'{}')
+        task.update({'kind': 'tasks#task', 'id': f"t{next(self.ids)}", 'status': 'needsAction', 'updated': self.rfc3339_now()})
+        self.google_tasks[task['id']] = task
+        return self.json_response(task)
+
+    def handle_tasks_tasks_patch(self, match, query, headers, body):
+        task = self.google_tasks.get(match.group(2))
+        if task is None:
+            return self.error(404, "Task not found", 'notFound')
+        task.update(json.loads(body or b'{}'))
+        task['updated'] = self.rfc3339_now()
+        return self.json_response(task)
+
+    # --- Todoist -------------------------------------------------------------------------------
+
+    def handle_todoist_projects_list(self, match, query, headers, body):
+        return self.json_response({'results': self.todoist_projects, 'next_cursor': None})
+
+    def handle_todoist_sections_list(self, match, query, headers, body):
+        sections = [section for section in self.todoist_sections if section['project_id'] == query.get('project_id', section['project_id'])]
+        return self.json_response({'results': sections, 'next_cursor': None})
+
+    def handle_todoist_tasks_list(self, match, query, headers, body):
+        items = [
+            item for item in self.todoist_items.values()
+            if not item['checked'] and item['section_id'] == query.get('section_id', item['section_id'])
+        ]
+        return self.json_response({'results': items, 'next_cursor': None})
+
+    def handle_todoist_tasks_completed(self, match, query, headers, body):
+        items = [
+            item for item in self.todoist_items.values()
+            if item['checked'] and not item['is_deleted'] and item['section_id'] == query.get('section_id', item['section_id'])
+        ]
+        return self.json_response({'items': items, 'next_cursor': None})
+
+    def add_todoist_item(self, args):
+        item = {
+            'id': f"i{next(self.ids)}",
+            'content': args['content'],
+            'project_id': args.get('project_id'),
+            'section_id': args.get('section_id'),
+            'labels': args.get('labels', []),
+            'priority': args.get('priority', 1),
+            'due': args.get('due') or ({'date': args['due_datetime']} if args.get('due_datetime') else None),
+            'checked': False,
+            'is_deleted': False,
+        }
+        self.todoist_items[item['id']] = item
+        return item
+
+    def handle_todoist_tasks_add(self, match, query, headers, body):
+        return self.json_response(self.add_todoist_item(json.loads(body or b'{}')))
+
+    def handle_todoist_sync(self, match, query, headers, body):
+        form = urllib.parse.parse_qs(body.decode('utf-8'))
+        commands = json.loads(form['commands'][0]) if 'commands' in form else []
+        resource_types = json.loads(form['resource_types'][0]) if 'resource_types' in form else []
+
+        sync_status = {}
+        temp_id_mapping = {}
+        for command in commands:
+            args = command.get('args', {})
+            if command['type'] == 'item_add':
+                item = self.add_todoist_item(args)
+                temp_id_mapping[command['temp_id']] = item['id']
+                sync_status[command['uuid']] = 'ok'
+            elif command['type'] in ('item_update', 'item_close') and args.get('id') in self.todoist_items:
+                item = self.todoist_items[args['id']]
+                if command['type'] == 'item_close':
+                    item['checked'] = True
+                else:
+                    item.update({key: value for key, value in args.items() if key != 'id'})
+                sync_status[command['uuid']] = 'ok'
+            else:
+                sync_status[command['uuid']] = {'error': 'Item not found', 'error_code': 22, 'http_code': 404}
+
+        payload = {'sync_token': uuid.uuid4().hex, 'full_sync': True, 'sync_status': sync_status, 'temp_id_mapping': temp_id_mapping}
+        if 'items' in resource_types or 'all' in resource_types:
+            payload['items'] = [item for item in self.todoist_items.values() if not item['checked']]
+        if 'projects' in resource_types or 'all' in resource_types:
+            payload['projects'] = self.todoist_projects
+        if 'sections' in resource_types or 'all' in resource_types:
+            payload['sections'] = self.todoist_sections
+        return self.json_response(payload)
+
+
+class FakeRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def dispatch(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        status, headers, payload = self.server.backend.handle_http(self.command, self.path, self.headers, body)
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    do_GET = do_POST = do_PATCH = do_PUT = do_DELETE = dispatch
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeServer:
+    """Runs a FakeBackend on a local port in a background thread; use as a context manager"""
+
+    def __init__(self, backend, host='127.0.0.1', port=0):
+        self.backend = backend
+        self.httpd = ThreadingHTTPServer((host, port), FakeRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.backend = backend
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.httpd.shutdown()
+        self.httpd.server_close()
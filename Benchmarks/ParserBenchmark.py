@@ -0,0 +1,80 @@
+import argparse
+import datetime
+import re
+import sys
+import time
+from Benchmarks.Corpus import build_corpus
+from Common.BrightspaceParser import parse_activity_summary, parse_due_date
+from Common.ParsePool import parse_bodies
+
+
+def legacy_parse(email_body):
+    # The per-line split/recompile parser break_down_email used before Common.BrightspaceParser, kept as a baseline
+    assignments = []
+    courseName = ""
+    task_name_pattern = re.compile(r"^(.*?)<")
+
+    lines = email_body.split("\n")
+    for i in range(len(lines)):
+        lines[i] = lines[i].replace("FW: ", "")
+        parts = lines[i].split(' ')
+        if courseName == "" and "Activity summary for" in lines[i]:
+            parts = parts[5:]
+            courseName = "".join(parts[1:3])
+        elif "- Due date is in" in lines[i] and courseName != "":
+            taskName = task_name_pattern.search(lines[i]).group(1).strip()
+            clean_time_string = lines[i + 1].lstrip(": ").strip().replace("Due date: ", "")
+            dueDate = datetime.datetime.strptime(clean_time_string[:-4].strip(), "%A, %B %d, %Y %I:%M %p")
+            assignments.append((taskName, courseName, dueDate))
+    return assignments
+
+
+def measure(parse, bodies, repeat):
+    best = None
+    for _ in range(repeat):
+        parse_due_date.cache_clear()
+        start = time.perf_counter()
+        for body in bodies:
+            parse(body)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return len(bodies) / best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmark for the Brightspace Activity summary parser")
+    parser.add_argument('--emails', type=int, default=2000, help="number of synthetic digests to parse")
+    parser.add_argument('--repeat', type=int, default=5, help="runs per parser; the best one is reported")
+    parser.add_argument('--seed', type=int, default=7)
+    parser.add_argument('--workers', type=int, default=0, help="also measure the process pool with this many workers")
+    parser.add_argument('--min-rate', type=float, default=None, help="exit non-zero if the parser falls below this many emails/second")
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.emails, args.seed)
+    bodies = [body for body, _ in corpus]
+
+    mismatches = sum(1 for body, expected in corpus if [tuple(a) for a in parse_activity_summary(body)] != expected)
+    if mismatches:
+        print(f"Parser output differs from the expected assignments for {mismatches} emails.")
+        sys.exit(1)
+
+    legacy_rate = measure(legacy_parse, bodies, args.repeat)
+    rate = measure(parse_activity_summary, bodies, args.repeat)
+    assignment_count = sum(len(expected) for _, expected in corpus)
+    print(f"Corpus: {len(bodies)} emails, {assignment_count} assignments")
+    print(f"Legacy parser: {legacy_rate:,.0f} emails/second")
+    print(f"Parser:        {rate:,.0f} emails/second ({rate / legacy_rate:.1f}x)")
+    if args.workers:
+        def parse_all_in_pool(_):
+            for _ in parse_bodies(((position, [body]) for position, body in enumerate(bodies)), args.workers):
+                pass
+        pool_rate = measure(parse_all_in_pool, [None], args.repeat) * len(bodies)
+        print(f"Parse pool:    {pool_rate:,.0f} emails/second with {args.workers} workers")
+
+    if args.min_rate is not None and rate < args.min_rate:
+        print(f"Regression: {rate:,.0f} emails/second is below the required {args.min_rate:,.0f}.")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
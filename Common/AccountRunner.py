@@ -0,0 +1,116 @@
+import json
+import os
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from Common.Metrics import Metrics
+from Common.RequestScheduler import RequestScheduler
+
+
+class Account:
+    """One student's settings from the accounts file; anything left out falls back to the single-user Constants"""
+
+    def __init__(self, name, email, accounts_dir, project_name, section_name, gcal_sync, todoist_sync, todoist_token=None):
+        self.name = name
+        self.email = email
+        self.project_name = project_name
+        self.section_name = section_name
+        self.gcal_sync = gcal_sync
+        self.todoist_sync = todoist_sync
+        self.todoist_token = todoist_token
+        # Tokens, ledgers, caches and reports all live under accounts/<name>/
+        self.directory = os.path.join(accounts_dir, name)
+        os.makedirs(self.directory, exist_ok=True)
+        # Every account gets its own rate-limit budget and its own counters
+        self.metrics = Metrics()
+        self.scheduler = RequestScheduler(metrics=self.metrics)
+
+    def path(self, file_name):
+        return os.path.join(self.directory, file_name)
+
+    def get_todoist_token(self):
+        """The account's own Todoist token: todoist_token from the accounts file, else accounts/<name>/Token.json.
+
+        There is deliberately no fallback to the shared Todoist/Token.json, which would write every such
+        account's tasks into the same Todoist account.
+        """
+        if self.todoist_token:
+            return self.todoist_token
+        token_path = self.path('Token.json')
+        if not os.path.exists(token_path):
+            raise ValueError(f"No Todoist token for account {self.name}: set todoist_token in the accounts file or add {token_path}")
+        with open(token_path, 'r') as token_file:
+            return json.load(token_file)['API_Token']
+
+
+def load_accounts(accounts_path, accounts_dir, defaults):
+    with open(accounts_path, 'r') as accounts_file:
+        configs = json.load(accounts_file)
+
+    accounts = []
+    names = set()
+    for config in configs:
+        settings = dict(defaults)
+        settings.update(config)
+        # Each account owns accounts/<name>/, so two entries with one name would share tokens and ledgers
+        if settings['name'] in names:
+            raise ValueError(f"Account name {settings['name']!r} appears more than once in {accounts_path}")
+        names.add(settings['name'])
+        accounts.append(Account(
+            settings['name'],
+            settings['email'],
+            accounts_dir,
+            settings['project_name'],
+            settings['section_name'],
+            settings['gcal_sync'],
+            settings['todoist_sync'],
+            settings.get('todoist_token')
+        ))
+    return accounts
+
+
+class AccountRunner:
+    """Runs sync_account(account) for every account on a bounded pool of worker threads.
+
+    Any free worker takes the next account. Account names are unique (load_accounts checks),
+    so no account is synced by two threads at once.
+    """
+
+    def __init__(self, sync_account, workers=4):
+        self.sync_account = sync_account
+        self.workers = workers
+
+    def run(self, accounts):
+        """Returns {account name: {'error': ..., 'sinks': {sink name: error or None}, 'metrics': report}}"""
+        if not accounts:
+            return {}
+
+        with ThreadPoolExecutor(max_workers=min(self.workers, len(accounts)), thread_name_prefix='account') as executor:
+            return dict(executor.map(self.run_one, accounts))
+
+    def run_one(self, account):
+        result = {'error': None, 'sinks': {}}
+        try:
+            result['sinks'] = self.sync_account(account) or {}
+        except Exception as e:
+            # One account's failure (e.g. a revoked token) must not stop the others
+            print(f"Account {account.name} failed: {e}")
+            traceback.print_exc()
+            result['error'] = str(e)
+        result['metrics'] = account.metrics.report()
+        account.metrics.write_json(account.path('run_report.json'))
+        return account.name, result
+
+    @staticmethod
+    def print_summary(results):
+        print(f"{'Account':<24}{'Result':<10}Details")
+        for name, result in sorted(results.items()):
+            if result['error'] is not None:
+                print(f"{name:<24}{'failed':<10}{result['error']}")
+                continue
+            failed_sinks = {sink: error for sink, error in result['sinks'].items() if error is not None}
+            if failed_sinks:
+                details = ', '.join(f"{sink}: {error}" for sink, error in failed_sinks.items())
+                print(f"{name:<24}{'partial':<10}{details}")
+            else:
+                synced = ', '.join(result['sinks']) or 'nothing new'
+                print(f"{name:<24}{'ok':<10}{synced}")
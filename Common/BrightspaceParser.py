@@ -0,0 +1,99 @@
+import datetime
+import functools
+import io
+import re
+from collections import namedtuple
+
+# Bump whenever the parsing rules change; cached parse results from older versions are discarded
+PARSER_VERSION = 3
+
+Assignment = namedtuple('Assignment', ['task_name', 'course_name', 'due_date'])
+
+COURSE_MARKER = "Activity summary for"
+DUE_MARKER = "- Due date is in"
+FORWARD_PREFIX = "FW: "
+DUE_DATE_FORMAT = "%A, %B %d, %Y %I:%M %p"
+
+MONTHS = {datetime.date(2000, month, 1).strftime('%B').lower(): month for month in range(1, 13)}
+WEEKDAYS = {datetime.date(2000, 1, day).strftime('%A').lower() for day in range(3, 10)}
+# Matches DUE_DATE_FORMAT so the common case avoids the much slower strptime
+DUE_DATE_PATTERN = re.compile(r"([A-Za-z]+), ([A-Za-z]+) (\d{1,2}), (\d{4}) (\d{1,2}):(\d{2}) ([AaPp][Mm])")
+# The course code is the 7th and 8th space separated words of the summary line ("MA" + "17500-02")
+COURSE_PATTERN = re.compile(r"(?:[^ \n]* ){6}([^ \n]*)(?: ([^ \n]*))?")
+TASK_NAME_PATTERN = re.compile(r"([^<\n]*)<")
+
+
+@functools.lru_cache(maxsize=1024)
+def parse_due_date(due_line):
+    # Digests repeat the same handful of due dates, so parsed dates are memoised
+    clean_time_string = due_line.lstrip(": ").strip().replace("Due date: ", "")
+    # Drop the trailing time zone abbreviation, e.g. " EDT"
+    clean_time_string = clean_time_string[:-4].strip()
+
+    match = DUE_DATE_PATTERN.fullmatch(clean_time_string)
+    if match:
+        weekday, month_name, day, year, hour, minute, meridiem = match.groups()
+        month = MONTHS.get(month_name.lower())
+        hour = int(hour)
+        if weekday.lower() in WEEKDAYS and month and 1 <= hour <= 12:
+            hour = hour % 12 + (12 if meridiem.lower() == 'pm' else 0)
+            try:
+                return datetime.datetime(int(year), month, int(day), hour, int(minute))
+            except ValueError:
+                return None
+
+    try:
+        return datetime.datetime.strptime(clean_time_string, DUE_DATE_FORMAT)
+    except ValueError:
+        return None
+
+
+def parse_lines(lines):
+    """Parses an Activity summary digest from an iterable of lines into a list of Assignments.
+
+    Lines may keep their trailing newline. Tasks without a '<' link or with an unparseable due date
+    are skipped.
+    """
+    assignments = []
+    course_name = ""
+    pending_task = None
+
+    for line in lines:
+        if pending_task is not None:
+            # The line after a "Due date is in" line carries the due date itself
+            due_date = parse_due_date(line)
+            if due_date is not None:
+                assignments.append(Assignment(pending_task, course_name, due_date))
+            pending_task = None
+
+        if FORWARD_PREFIX in line:
+            line = line.replace(FORWARD_PREFIX, "")
+
+        if not course_name:
+            if COURSE_MARKER in line:
+                match = COURSE_PATTERN.match(line)
+                if match:
+                    course_name = match.group(1) + (match.group(2) or "")
+        elif DUE_MARKER in line:
+            match = TASK_NAME_PATTERN.match(line)
+            if match:
+                pending_task = match.group(1).strip()
+
+    return assignments
+
+
+def parse_activity_summary(body):
+    """Parses a decoded email body; see parse_lines"""
+    return parse_lines(io.StringIO(body))
+
+
+def parse_first_digest(bodies):
+    """Parses the candidate bodies of one message, each an iterable of lines, and returns the first non-empty result.
+
+    A digest forwarded as an attachment comes after the forwarder's own note, so the first body is not always the one.
+    """
+    for lines in bodies:
+        assignments = parse_lines(lines)
+        if assignments:
+            return assignments
+    return []
@@ -0,0 +1,91 @@
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+
+class Metrics:
+    """Thread-safe stage timers and event counters for one sync run.
+
+    Timers accumulate call count, total and max seconds per stage; counters are plain integers
+    (API calls, retries, cache hits, skipped tasks, ...). Both export as a JSON run report or in
+    the Prometheus text format read by the node exporter's textfile collector.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.timers = {}
+        self.counters = collections.Counter()
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_duration(stage, time.perf_counter() - start)
+
+    def record_duration(self, stage, seconds):
+        with self.lock:
+            timer = self.timers.setdefault(stage, {'count': 0, 'total_seconds': 0.0, 'max_seconds': 0.0})
+            timer['count'] += 1
+            timer['total_seconds'] += seconds
+            timer['max_seconds'] = max(timer['max_seconds'], seconds)
+
+    def incr(self, counter, amount=1):
+        with self.lock:
+            self.counters[counter] += amount
+
+    def reset(self):
+        with self.lock:
+            self.started_at = time.time()
+            self.timers = {}
+            self.counters = collections.Counter()
+
+    def report(self):
+        with self.lock:
+            return {
+                'started_at': self.started_at,
+                'duration_seconds': round(time.time() - self.started_at, 4),
+                'timers': {
+                    stage: {key: round(value, 4) if isinstance(value, float) else value for key, value in timer.items()}
+                    for stage, timer in sorted(self.timers.items())
+                },
+                'counters': dict(sorted(self.counters.items())),
+            }
+
+    def write_json(self, path):
+        self.write_atomically(path, json.dumps(self.report(), indent=2) + '\n')
+
+    def write_prometheus(self, path, prefix='sync_assignments'):
+        report = self.report()
+        lines = [
+            f'# TYPE {prefix}_last_run_timestamp_seconds gauge',
+            f'{prefix}_last_run_timestamp_seconds {report["started_at"]:.0f}',
+            f'# TYPE {prefix}_run_duration_seconds gauge',
+            f'{prefix}_run_duration_seconds {report["duration_seconds"]}',
+            f'# TYPE {prefix}_stage_seconds_total gauge',
+        ]
+        lines.extend(f'{prefix}_stage_seconds_total{{stage="{stage}"}} {timer["total_seconds"]}' for stage, timer in report['timers'].items())
+        lines.append(f'# TYPE {prefix}_stage_max_seconds gauge')
+        lines.extend(f'{prefix}_stage_max_seconds{{stage="{stage}"}} {timer["max_seconds"]}' for stage, timer in report['timers'].items())
+        lines.append(f'# TYPE {prefix}_stage_calls_total gauge')
+        lines.extend(f'{prefix}_stage_calls_total{{stage="{stage}"}} {timer["count"]}' for stage, timer in report['timers'].items())
+        lines.append(f'# TYPE {prefix}_events_total gauge')
+        lines.extend(f'{prefix}_events_total{{event="{counter}"}} {value}' for counter, value in report['counters'].items())
+        self.write_atomically(path, '\n'.join(lines) + '\n')
+
+    @staticmethod
+    def write_atomically(path, content):
+        # The textfile collector may read at any moment, so never expose a half-written file
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as output_file:
+            output_file.write(content)
+        os.replace(temp_path, path)
+
+
+# Shared by every component unless one is handed its own Metrics instance
+run_metrics = Metrics()
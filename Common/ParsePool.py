@@ -0,0 +1,41 @@
+import collections
+import itertools
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+import io
+from Common.BrightspaceParser import parse_first_digest
+
+
+def parse_chunk(chunk):
+    # Runs in a worker process; candidate lists that are None were already parsed and are passed through
+    return [
+        (message_id, None if bodies is None else parse_first_digest(io.StringIO(body) for body in bodies))
+        for message_id, bodies in chunk
+    ]
+
+
+def parse_bodies(bodies, workers=None, chunk_size=100):
+    """Parses (message_id, candidate bodies) pairs on a process pool, yielding (message_id, assignments) in input order.
+
+    Each message's candidate bodies are tried in order, as in GmailReader.parse_emails.
+
+    At most two chunks per worker are in flight, so arbitrarily long backfills stream through in bounded memory.
+    """
+    workers = workers or os.cpu_count() or 1
+    bodies = iter(bodies)
+    in_flight = collections.deque()
+
+    # Sink threads are already running when this is called from a pipeline, and forking a threaded process can
+    # deadlock; forkserver starts workers from a clean single-threaded server (spawn where fork is unavailable)
+    method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method)) as executor:
+        while True:
+            while len(in_flight) < workers * 2:
+                chunk = list(itertools.islice(bodies, chunk_size))
+                if not chunk:
+                    break
+                in_flight.append(executor.submit(parse_chunk, chunk))
+            if not in_flight:
+                return
+            yield from in_flight.popleft().result()
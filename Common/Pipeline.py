@@ -0,0 +1,110 @@
+import queue
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from Common.Metrics import run_metrics
+
+_END_OF_STREAM = object()
+_ABORTED = object()
+
+
+class PartialSyncError(Exception):
+    """Raised by a sink that consumed its whole stream but could not write some of the tasks"""
+
+
+class StreamAbortedError(Exception):
+    """Raised inside a sink's stream when the producer failed, so a partial stream is never taken as complete"""
+
+
+class SinkFailures:
+    """Counts the tasks a sink could not write during one sync_stream"""
+
+    def __init__(self, sink_name, counter, metrics=None):
+        self.sink_name = sink_name
+        self.counter = counter
+        self.metrics = metrics or run_metrics
+        self.count = 0
+
+    def reset(self):
+        self.count = 0
+
+    def record(self, count=1):
+        self.count += count
+        self.metrics.incr(self.counter, count)
+
+    def raise_if_any(self):
+        # Lets the caller hold back its checkpoint, so the failed tasks are read and retried next run
+        if self.count:
+            raise PartialSyncError(f"{self.count} tasks could not be synced to {self.sink_name}")
+
+
+class SyncPipeline:
+    """Fans parsed assignments out to every enabled sink while the reader is still producing them.
+
+    Each sink gets its own bounded queue and worker thread and consumes it through sync_stream().
+    A sink that raises is reported and stops receiving items; the other sinks carry on. Sinks raise
+    PartialSyncError after the stream when some writes failed, so the run is not taken as complete.
+    If the producer raises, each sink's stream raises StreamAbortedError instead of ending normally.
+    """
+
+    PUT_TIMEOUT = 0.5
+
+    def __init__(self, sinks, queue_size=100, metrics=None):
+        self.sinks = sinks
+        self.queue_size = queue_size
+        self.metrics = metrics or run_metrics
+
+    def run(self, assignments):
+        """Returns {sink name: None on success or the exception that stopped it}"""
+        if not self.sinks:
+            for _ in assignments:
+                pass
+            return {}
+
+        queues = {name: queue.Queue(maxsize=self.queue_size) for name in self.sinks}
+        with ThreadPoolExecutor(max_workers=len(self.sinks), thread_name_prefix='sink') as executor:
+            futures = {
+                name: executor.submit(self.consume, name, sink, queues[name])
+                for name, sink in self.sinks.items()
+            }
+            end_marker = _ABORTED
+            try:
+                for assignment in assignments:
+                    for name, sink_queue in queues.items():
+                        self.offer(sink_queue, assignment, futures[name])
+                end_marker = _END_OF_STREAM
+            finally:
+                for name, sink_queue in queues.items():
+                    self.offer(sink_queue, end_marker, futures[name])
+
+            results = {}
+            for name, future in futures.items():
+                error = future.exception()
+                if error is not None:
+                    self.metrics.incr(f'sink.{name}.failed')
+                    print(f"{name} sync failed: {error}")
+                    if not isinstance(error, (PartialSyncError, StreamAbortedError)):
+                        traceback.print_exception(type(error), error, error.__traceback__)
+                results[name] = error
+        return results
+
+    def offer(self, sink_queue, item, future):
+        # Block while the queue is full, but give up on sinks whose worker has already stopped
+        while not future.done():
+            try:
+                sink_queue.put(item, timeout=self.PUT_TIMEOUT)
+                return
+            except queue.Full:
+                continue
+
+    def consume(self, name, sink, sink_queue):
+        def drain():
+            while True:
+                item = sink_queue.get()
+                if item is _END_OF_STREAM:
+                    return
+                if item is _ABORTED:
+                    raise StreamAbortedError("the assignment stream stopped before it was complete")
+                yield item
+
+        with self.metrics.timer(f'sink.{name}'):
+            sink.sync_stream(drain())
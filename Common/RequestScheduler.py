@@ -0,0 +1,293 @@
+import asyncio
+import email.utils
+import random
+import threading
+import time
+import httpx
+import requests
+from Common.Metrics import run_metrics
+
+# Per-service token buckets: (tokens refilled per second, burst capacity)
+SERVICE_LIMITS = {
+    'gmail': (250, 250),        # Gmail quota units, 250 per user per second
+    'tasks': (50, 50),          # Google Tasks requests
+    'todoist': (1000 / 900, 50),  # Todoist allows about 1000 requests per 15 minutes
+    'graph': (10000 / 600, 100),  # Outlook allows 10,000 requests per 10 minutes per mailbox; $batch items count individually
+}
+
+# Gmail charges each method a different number of quota units
+GMAIL_QUOTA_UNITS = {
+    'getProfile': 1,
+    'history.list': 2,
+    'messages.list': 5,
+    'messages.get': 5,
+}
+
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+# Statuses that mean the server did not carry the request out, so even a non-idempotent write can be resent
+UNPROCESSED_STATUSES = {429, 503}
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, cost=1):
+        """Takes cost tokens, going into debt if needed, and returns how many seconds to wait before using them"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            self.tokens -= cost
+            return max(0.0, -self.tokens / self.rate)
+
+
+class CircuitBreaker:
+    """Opens after failure_threshold consecutive failures and rejects calls until reset_timeout has passed"""
+
+    def __init__(self, failure_threshold=5, reset_timeout=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def before_call(self, service):
+        with self.lock:
+            if self.opened_at is not None and time.monotonic() - self.opened_at < self.reset_timeout:
+                raise CircuitOpenError(f"{service} circuit is open after {self.failures} consecutive failures")
+            # Past the timeout the breaker is half open: the next call decides whether it closes again
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+
+
+class RequestScheduler:
+    """Single gate for outbound API calls.
+
+    Each call takes its cost from the service's token bucket, is retried on 429, 5xx and connection
+    errors with exponential backoff and full jitter (or after the server's Retry-After), and is
+    rejected outright while the service's circuit breaker is open. Calls made with idempotent=False
+    (e.g. creating a task) are only retried when the server says it did not process them.
+    """
+
+    def __init__(self, limits=None, max_retries=5, base_delay=1.0, max_delay=60.0, failure_threshold=5, reset_timeout=60, metrics=None):
+        limits = limits or SERVICE_LIMITS
+        self.buckets = {service: TokenBucket(rate, capacity) for service, (rate, capacity) in limits.items()}
+        self.breakers = {service: CircuitBreaker(failure_threshold, reset_timeout) for service in limits}
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.metrics = metrics or run_metrics
+
+    def call(self, service, request, cost=1, idempotent=True):
+        """Runs request() under the service's limits and returns its result"""
+        attempt = 0
+        while True:
+            self.breakers[service].before_call(service)
+            time.sleep(self.buckets[service].reserve(cost))
+            try:
+                result = request()
+            except Exception as e:
+                delay = self.next_delay(service, e, attempt, idempotent)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+            else:
+                self.breakers[service].record_success()
+                return result
+
+    async def call_async(self, service, request, cost=1, idempotent=True):
+        """call() for a coroutine function; waits with asyncio.sleep instead of blocking the loop"""
+        attempt = 0
+        while True:
+            self.breakers[service].before_call(service)
+            await asyncio.sleep(self.buckets[service].reserve(cost))
+            try:
+                result = await request()
+            except Exception as e:
+                delay = self.next_delay(service, e, attempt, idempotent)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+            else:
+                self.breakers[service].record_success()
+                return result
+
+    def execute_batches(self, service, requests_by_key, new_batch, batch_size, cost=1, idempotent=None, stop_on=None, timer=None, metrics=None):
+        """Sends {key: request} as batch requests of up to batch_size parts, resending only the parts that failed retryably.
+
+        new_batch(callback) returns an empty batch (e.g. a googleapiclient BatchHttpRequest), and each batch is
+        charged cost per part. idempotent(key) says whether a part may be resent after a timeout or 5xx, and
+        stop_on(error) marks errors that end the whole call: the first such error is raised once its batch is done.
+        Returns ({key: response}, {key: error}) for the parts that succeeded and the parts that were given up on.
+        """
+        metrics = metrics or self.metrics
+        idempotent = idempotent or (lambda key: True)
+        keys = list(requests_by_key)
+        results = {}
+        errors = {}
+        retry_errors = {}
+
+        # Batch request ids are positions in keys; long keys do not survive as multipart Content-IDs
+        def handle_response(request_id, response, exception):
+            key = keys[int(request_id)]
+            if exception is None:
+                results[key] = response
+            elif self.is_retryable(exception, idempotent(key)):
+                retry_errors[key] = exception
+            else:
+                errors[key] = exception
+
+        def raise_stop_error():
+            for error in errors.values():
+                if stop_on is not None and stop_on(error):
+                    raise error
+
+        positions = {key: str(position) for position, key in enumerate(keys)}
+        for start in range(0, len(keys), batch_size):
+            pending_keys = keys[start:start + batch_size]
+            attempt = 0
+            while pending_keys:
+                # The batch as a whole may only be resent if every part in it may be
+                pending_idempotent = all(idempotent(key) for key in pending_keys)
+                retry_errors.clear()
+                batch = new_batch(handle_response)
+                for key in pending_keys:
+                    batch.add(requests_by_key[key], request_id=positions[key])
+                metrics.incr(f'api_calls.{service}.batch')
+                with metrics.timer(timer or f'{service}.batch'):
+                    self.call(service, batch.execute, cost * len(pending_keys), pending_idempotent)
+                raise_stop_error()
+                if not retry_errors:
+                    break
+
+                error = next(iter(retry_errors.values()))
+                if not self.wait_before_retry(service, error, attempt, pending_idempotent):
+                    errors.update(retry_errors)
+                    raise_stop_error()
+                    break
+                pending_keys = list(retry_errors)
+                attempt += 1
+        return results, errors
+
+    def wait_before_retry(self, service, error, attempt, idempotent=True):
+        """For callers that retry themselves (e.g. failed parts of a batch): sleeps and returns True if error should be retried"""
+        delay = self.next_delay(service, error, attempt, idempotent)
+        if delay is None:
+            return False
+        time.sleep(delay)
+        return True
+
+    def next_delay(self, service, error, attempt, idempotent=True):
+        # None means give up and let the caller see the error
+        if not self.is_retryable(error, idempotent):
+            return None
+        # Throttling is handled by backing off; only outages and server errors count towards opening the circuit
+        if not self.is_rate_limited(error):
+            self.breakers[service].record_failure()
+        if attempt >= self.max_retries:
+            return None
+
+        retry_after = self.retry_after(error)
+        if retry_after is not None:
+            delay = retry_after + random.uniform(0, self.base_delay)
+        else:
+            delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        self.metrics.incr('retries')
+        self.metrics.incr(f'retries.{service}')
+        print(f"{service} request failed ({self.describe(error)}). Retrying in {delay:.1f}s...")
+        return delay
+
+    @staticmethod
+    def response_of(error):
+        # googleapiclient errors carry an httplib2 .resp, requests and httpx errors a .response
+        resp = getattr(error, 'resp', None)
+        if resp is not None:
+            return resp.status, resp
+        response = getattr(error, 'response', None)
+        if response is not None:
+            return response.status_code, response.headers
+        return None, {}
+
+    @classmethod
+    def is_retryable(cls, error, idempotent=True):
+        status, _ = cls.response_of(error)
+        if not idempotent:
+            # A timeout or 5xx may come after the write was applied; resending it could create a duplicate
+            return status in UNPROCESSED_STATUSES or cls.is_rate_limited(error)
+        if status is None:
+            return cls.is_connection_error(error)
+        return status in RETRYABLE_STATUSES or cls.is_rate_limited(error)
+
+    @classmethod
+    def is_rate_limited(cls, error):
+        status, _ = cls.response_of(error)
+        # Gmail reports per-user rate limiting as 403 rateLimitExceeded / userRateLimitExceeded
+        return status == 429 or (status == 403 and 'ratelimitexceeded' in cls.error_text(error))
+
+    @classmethod
+    def is_quota_error(cls, error):
+        """Throttling or an exhausted quota: a long-running caller should stop and resume later instead of dropping the request"""
+        status, _ = cls.response_of(error)
+        message = cls.error_text(error)
+        return cls.is_rate_limited(error) or (status == 403 and ('quotaexceeded' in message or 'dailylimitexceeded' in message))
+
+    @staticmethod
+    def error_text(error):
+        # googleapiclient puts the error reason in the message; requests and httpx only have it in the response body
+        text = str(error)
+        response = getattr(error, 'response', None)
+        if response is not None:
+            try:
+                text += ' ' + response.text
+            except Exception:
+                pass
+        return text.lower()
+
+    @staticmethod
+    def is_connection_error(error):
+        return isinstance(error, (ConnectionError, TimeoutError, requests.ConnectionError, requests.Timeout, httpx.TransportError))
+
+    @classmethod
+    def retry_after(cls, error):
+        _, headers = cls.response_of(error)
+        value = headers.get('retry-after') or headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            retry_at = email.utils.parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        return max(0.0, retry_at.timestamp() - time.time())
+
+    @classmethod
+    def describe(cls, error):
+        status, _ = cls.response_of(error)
+        return f"HTTP {status}" if status is not None else type(error).__name__
+
+
+# Shared by every component unless one is handed its own RequestScheduler
+default_scheduler = RequestScheduler()
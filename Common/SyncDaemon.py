@@ -0,0 +1,116 @@
+import datetime
+import threading
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class AdaptivePollInterval:
+    """Polls at min_interval during busy hours and right after new mail, backing off towards max_interval when idle.
+
+    Busy hours are the configured digest hours plus every hour in which new assignments arrived during the
+    last learned_days days; a learned hour that stays quiet for longer stops counting as busy.
+    """
+
+    def __init__(self, min_interval, max_interval, busy_hours=(), backoff=2.0, learned_days=7):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.configured_hours = set(busy_hours)
+        self.learned_hours = {}  # hour -> when new assignments last arrived in it
+        self.learned_days = learned_days
+        self.backoff = backoff
+        self.interval = min_interval
+
+    def next_interval(self, found_new, now=None):
+        now = now or datetime.datetime.now()
+        if found_new:
+            self.learned_hours[now.hour] = now
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_interval, self.interval * self.backoff)
+
+        busy_hours = self.busy_hours(now)
+        if now.hour in busy_hours:
+            return self.min_interval
+        # Never sleep through the start of the next busy hour
+        return min(self.interval, self.seconds_until_busy_hour(now, busy_hours))
+
+    def busy_hours(self, now):
+        cutoff = now - datetime.timedelta(days=self.learned_days)
+        self.learned_hours = {hour: seen_at for hour, seen_at in self.learned_hours.items() if seen_at >= cutoff}
+        return self.configured_hours | set(self.learned_hours)
+
+    def seconds_until_busy_hour(self, now, busy_hours):
+        next_hour = now.replace(minute=0, second=0, microsecond=0)
+        for _ in range(24):
+            next_hour += datetime.timedelta(hours=1)
+            if next_hour.hour in busy_hours:
+                return max(self.min_interval, (next_hour - now).total_seconds())
+        return self.max_interval
+
+
+class WebhookTrigger:
+    """Local stand-in for a Gmail push endpoint: any POST wakes the daemon up for an immediate check"""
+
+    def __init__(self, wake_event, host='127.0.0.1', port=8765):
+        self.wake_event = wake_event
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                self.rfile.read(length)
+                self.send_response(204)
+                self.end_headers()
+                wake_event.set()
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        host, port = self.httpd.server_address[:2]
+        print(f"Listening for push notifications on http://{host}:{port}")
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class SyncDaemon:
+    """Calls sync_once() in a loop; sync_once returns True when it found new assignments"""
+
+    def __init__(self, sync_once, poll_interval, webhook_port=None):
+        self.sync_once = sync_once
+        self.poll_interval = poll_interval
+        self.webhook_port = webhook_port
+        self.wake_event = threading.Event()
+
+    def run(self):
+        if self.webhook_port is None:
+            self.loop()
+            return
+        with WebhookTrigger(self.wake_event, port=self.webhook_port):
+            self.loop()
+
+    def loop(self):
+        try:
+            while True:
+                try:
+                    found_new = self.sync_once()
+                except Exception as e:
+                    # Keep the daemon alive through transient failures; the next check retries the same history
+                    print(f"Sync failed: {e}")
+                    traceback.print_exc()
+                    found_new = False
+
+                delay = self.poll_interval.next_interval(found_new)
+                print(f"Next check in {delay:.0f}s.")
+                if self.wake_event.wait(delay):
+                    print("Push notification received.")
+                self.wake_event.clear()
+        except KeyboardInterrupt:
+            print("Stopping.")
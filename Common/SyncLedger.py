@@ -0,0 +1,101 @@
+import os
+import datetime
+import heapq
+import json
+
+
+class SyncLedger:
+    """Keyed record of synced tasks, shared by the Google Tasks and Todoist sinks.
+
+    Records live in a dict for O(1) lookups and are persisted as JSON lines. New records are
+    appended on flush(); the file is only rewritten when entries expire or superseded lines pile up.
+    """
+
+    def __init__(self, ledger_path, legacy_log_path=None):
+        self.ledger_path = ledger_path
+        self.records = {}
+        self.expiry_index = []  # min-heap of (expires_at, key)
+        self.pending_lines = []
+        self.stale_lines = 0
+        self.needs_rewrite = False
+
+        if os.path.exists(self.ledger_path):
+            self.load()
+        elif legacy_log_path and os.path.exists(legacy_log_path):
+            self.import_legacy_log(legacy_log_path)
+
+    def load(self):
+        with open(self.ledger_path, 'r') as ledger_file:
+            for line in ledger_file:
+                if not line.strip():
+                    continue
+                entry = json.loads(line)
+                if entry['key'] in self.records:
+                    self.stale_lines += 1
+                self.records[entry['key']] = entry
+        self.expiry_index = [(entry['expires_at'], key) for key, entry in self.records.items()]
+        heapq.heapify(self.expiry_index)
+
+    def import_legacy_log(self, legacy_log_path):
+        # Old logs were either one JSON array or one JSON object per line, keyed by 'task_name'
+        with open(legacy_log_path, 'r') as log_file:
+            content = log_file.read().strip()
+        if not content:
+            return
+        if content.startswith('['):
+            legacy_tasks = json.loads(content)
+        else:
+            legacy_tasks = [json.loads(line) for line in content.splitlines() if line.strip()]
+
+        for task in legacy_tasks:
+            due_date = datetime.datetime.fromisoformat(task['due_date'].rstrip('Z'))
+            self.add(task['task_name'], due_date, task)
+        print(f"Imported {len(legacy_tasks)} tasks from {os.path.basename(legacy_log_path)} into the sync ledger.")
+        self.needs_rewrite = True
+
+    def __contains__(self, key):
+        return key in self.records
+
+    def __len__(self):
+        return len(self.records)
+
+    def get(self, key):
+        entry = self.records.get(key)
+        return entry['record'] if entry else None
+
+    def add(self, key, due_date, record):
+        entry = {'key': key, 'expires_at': due_date.timestamp(), 'record': record}
+        if key in self.records:
+            self.stale_lines += 1
+        self.records[key] = entry
+        heapq.heappush(self.expiry_index, (entry['expires_at'], key))
+        self.pending_lines.append(json.dumps(entry))
+
+    def expire(self, now):
+        """Drops every record due at or before now; returns how many were removed"""
+        cutoff = now.timestamp()
+        expired = 0
+        while self.expiry_index and self.expiry_index[0][0] <= cutoff:
+            expires_at, key = heapq.heappop(self.expiry_index)
+            entry = self.records.get(key)
+            # Skip heap entries left behind when a key was re-added with a new due date
+            if entry is not None and entry['expires_at'] == expires_at:
+                del self.records[key]
+                expired += 1
+        if expired:
+            self.needs_rewrite = True
+        return expired
+
+    def flush(self):
+        if self.needs_rewrite or self.stale_lines > len(self.records):
+            temp_path = self.ledger_path + '.tmp'
+            with open(temp_path, 'w') as ledger_file:
+                for entry in self.records.values():
+                    ledger_file.write(json.dumps(entry) + '\n')
+            os.replace(temp_path, self.ledger_path)
+            self.stale_lines = 0
+            self.needs_rewrite = False
+        elif self.pending_lines:
+            with open(self.ledger_path, 'a') as ledger_file:
+                ledger_file.write('\n'.join(self.pending_lines) + '\n')
+        self.pending_lines = []
@@ -3,6 +3,44 @@ EMAIL = "anana06@pfw.edu"
 GCAL_SYNC = False
 TODOIST_SYNC = True
 
+# ACCOUNTS (python Main.py --accounts)
+# JSON list of {"name", "email", "project_name", "section_name", "gcal_sync", "todoist_sync", "todoist_token"};
+# omitted keys fall back to the settings in this file. Paths are relative to the repository root.
+# Accounts with todoist_sync need their own token, as todoist_token or in ACCOUNTS_DIR/<name>/Token.json.
+ACCOUNTS_FILE = "accounts.json"
+# Per-account tokens, ledgers, caches and run reports are kept in ACCOUNTS_DIR/<name>/
+ACCOUNTS_DIR = "accounts"
+
+# METRICS
+# JSON run report written after every run, relative to the repository root (None to disable)
+METRICS_REPORT_PATH = "run_report.json"
+# Prometheus textfile for the node exporter's textfile collector, e.g. "/var/lib/node_exporter/sync_assignments.prom"
+PROMETHEUS_TEXTFILE_PATH = None
+
+# GMAIL
+# Only fetch messages added since the last successful run (falls back to a bounded query)
+GMAIL_INCREMENTAL_SYNC = True
+
+# DAEMON (python Main.py --daemon)
+# Seconds between history checks: the minimum right after new mail and during digest hours, backing off to the maximum when idle
+DAEMON_MIN_INTERVAL = 60
+DAEMON_MAX_INTERVAL = 900
+# Local hours at which Brightspace usually sends activity summaries
+DAEMON_DIGEST_HOURS = [6, 7, 8]
+# Other hours in which new assignments arrived also count as busy, until they have been quiet for this many days
+DAEMON_LEARNED_HOUR_DAYS = 7
+# Port for a local push-notification endpoint; any POST triggers an immediate check (None to disable)
+DAEMON_WEBHOOK_PORT = None
+
 # TODOIST
 PROJECT_NAME = "ToDo"
 SECTION_NAME = "Abhisar"
+# Create tasks through batched Sync API requests instead of one REST call per task
+TODOIST_BULK_SYNC = True
+# Read the section's open tasks once and send only creates and due-date updates (takes precedence over TODOIST_BULK_SYNC).
+# Tasks deleted in Todoist are recreated while they are still in the digests; tasks completed there are left alone.
+TODOIST_RECONCILE = False
+# With TODOIST_RECONCILE, also close open tasks in the section that are not among the synced assignments.
+# Only safe when every run sees all current assignments, e.g. a full --backfill of the term; runs whose
+# stream stopped early (quota, errors) never close anything.
+TODOIST_RECONCILE_CLOSE = False
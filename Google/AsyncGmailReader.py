@@ -0,0 +1,126 @@
+import asyncio
+import datetime
+import httpx
+from google.auth.transport.requests import Request
+from Google.GmailReader import GmailReader
+from Common.RequestScheduler import GMAIL_QUOTA_UNITS
+
+GMAIL_API_URL = 'https://gmail.googleapis.com/gmail/v1/users/me'
+
+class AsyncGmailReader:
+    """asyncio front end for GmailReader: fetches over a pooled httpx client, parses with the reader"""
+
+    def __init__(self, reader, max_concurrency=10, max_connections=20, api_url=GMAIL_API_URL):
+        self.reader = reader
+        self.api_url = api_url
+        self.max_concurrency = max_concurrency
+        self.max_connections = max_connections
+        self.client = None
+        self.semaphore = None
+        self.refresh_lock = None
+
+    async def __aenter__(self):
+        if self.reader.creds is None:
+            # Loading or refreshing the token, or the browser consent flow on a first run, all block
+            await asyncio.to_thread(self.reader.authenticate)
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.refresh_lock = asyncio.Lock()
+        self.client = httpx.AsyncClient(
+            base_url=self.api_url,
+            limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections),
+            timeout=30
+        )
+        return self
+
+    async def __aexit__(self, exc_type, exc, traceback):
+        await self.client.aclose()
+        self.client = None
+
+    async def authorization_header(self):
+        creds = self.reader.creds
+        if not creds.valid:
+            async with self.refresh_lock:
+                if not creds.valid:
+                    # google-auth refreshes synchronously; keep it off the event loop
+                    await asyncio.to_thread(creds.refresh, Request())
+        return {'Authorization': f'Bearer {creds.token}'}
+
+    async def get_json(self, path, params=None, cost=1):
+        async def request():
+            async with self.semaphore:
+                response = await self.client.get(path, params=params, headers=await self.authorization_header())
+            response.raise_for_status()
+            return response.json()
+
+        return await self.reader.scheduler.call_async('gmail', request, cost)
+
+    async def list_message_page(self, query, page_token=None):
+        params = {'q': query}
+        if page_token:
+            params['pageToken'] = page_token
+        self.reader.metrics.incr('api_calls.gmail.messages.list')
+        with self.reader.metrics.timer('gmail.list'):
+            return await self.get_json('/messages', params, GMAIL_QUOTA_UNITS['messages.list'])
+
+    async def get_message(self, message_id):
+        self.reader.metrics.incr('api_calls.gmail.messages.get')
+        try:
+            with self.reader.metrics.timer('gmail.get'):
+                message = await self.get_json(f'/messages/{message_id}', {'format': 'full', 'fields': 'snippet,' + GmailReader.BODY_FIELDS}, GMAIL_QUOTA_UNITS['messages.get'])
+        except httpx.HTTPError as e:
+            # As in GmailReader.batch_get, only errors that will not go away are skipped; throttling, exhausted
+            # quota and outages the scheduler gave up on are raised so the caller does not lose the message
+            if self.reader.scheduler.is_retryable(e) or self.reader.scheduler.is_quota_error(e):
+                raise
+            print(f"Error fetching message {message_id}:", e)
+            return None
+        return {'id': message_id, 'snippet': message.get('snippet', ''), 'payload': message['payload']}
+
+    async def stream_query(self, query):
+        # Yields one list of messages per listing page; the next page is listed while this one is fetched
+        next_page = asyncio.create_task(self.list_message_page(query))
+        while next_page is not None:
+            results = await next_page
+            page_token = results.get('nextPageToken')
+            next_page = asyncio.create_task(self.list_message_page(query, page_token)) if page_token else None
+
+            message_ids = [message['id'] for message in results.get('messages', [])]
+            cached = self.reader.cache.get_many(message_ids) if self.reader.cache else {}
+            if self.reader.cache:
+                self.reader.metrics.incr('gmail.cache.hits', len(cached))
+                self.reader.metrics.incr('gmail.cache.misses', len(message_ids) - len(cached))
+            fetched = await asyncio.gather(*(
+                self.get_message(message_id) for message_id in message_ids if message_id not in cached
+            ))
+            fetched = {email['id']: email for email in fetched if email is not None}
+
+            page = []
+            for message_id in message_ids:
+                if message_id in cached:
+                    page.append({'id': message_id, 'assignments': cached[message_id]})
+                elif message_id in fetched:
+                    page.append(fetched[message_id])
+            yield page
+
+    async def stream_messages(self, sender_email):
+        today = datetime.datetime.now().strftime('%Y/%m/%d')
+        async for page in self.stream_query(f'from:{sender_email} after:{today}'):
+            yield page
+
+    async def break_down_email(self, sender_email):
+        async for page in self.stream_messages(sender_email):
+            # Decoding and parsing are CPU bound; keep them off the loop so listing and fetches carry on
+            await asyncio.to_thread(self.reader.break_down_email, page)
+        return self.reader.tasks
+
+
+# Usage example:
+if __name__ == '__main__':
+    async def main():
+        reader = GmailReader('client_secret.json')
+        async with AsyncGmailReader(reader) as async_reader:
+            tasks = await async_reader.break_down_email('anana06@pfw.edu')
+        reader.close()
+        print("Tasks: ", tasks)
+
+    asyncio.run(main())
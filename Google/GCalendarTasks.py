@@ -1,98 +1,181 @@
 import os
 import datetime
 import json
-from googleapiclient.discovery import build
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from google.auth.exceptions import RefreshError
+from Google.GoogleAuth import get_service, new_batch_request
+from Common.SyncLedger import SyncLedger
+from Common.Metrics import run_metrics
+from Common.Pipeline import SinkFailures
+from Common.RequestScheduler import default_scheduler
 
 class GCalendarTasks:
-    def __init__(self, tasks, credentials_path='client_secret.json', token_path='TasksToken.json'):
+    BATCH_SIZE = 50
+
+    def __init__(self, tasks, credentials_path='client_secret.json', token_path='TasksToken.json', log_file_path='gTasks_ledger.jsonl', legacy_log_file_path='gTasks_log.json', remote_state_path='gTasks_remote.json', tasklist='@default', metrics=None, scheduler=None):
         self.path = os.path.dirname(os.path.abspath(__file__))
         self.tasks = tasks
         self.credentials_path = os.path.join(self.path, credentials_path)
         self.token_path = os.path.join(self.path, token_path)
+        self.ledger = SyncLedger(os.path.join(self.path, log_file_path), legacy_log_path=os.path.join(self.path, legacy_log_file_path))
+        self.remote_state_path = os.path.join(self.path, remote_state_path)
+        self.remote_state = None
+        self.tasks_by_title = {}
+        self.tasklist = tasklist
         self.service = None
+        self.batch_uri = None  # See new_batch_request
         self.SCOPES = ['https://www.googleapis.com/auth/tasks']
+        self.metrics = metrics or run_metrics
+        self.scheduler = scheduler or default_scheduler
+        self.failures = SinkFailures('Google Tasks', 'google_tasks.failed', self.metrics)
 
     def authenticate(self):
-        creds = None
-        if os.path.exists(self.token_path):
-            try:
-                creds = Credentials.from_authorized_user_file(self.token_path, self.SCOPES)
-            except Exception as e:
-                print("Error loading credentials:", e)
-                creds = None
-
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                try:
-                    creds.refresh(Request())
-                except RefreshError:
-                    print("Token expired or revoked. Re-authenticating...")
-                    creds = None  # Set creds to None to trigger re-authentication
-            if not creds:
-                flow = InstalledAppFlow.from_client_secrets_file(self.credentials_path, self.SCOPES)
-                creds = flow.run_local_server(port=0)
-                with open(self.token_path, 'w') as token:
-                    token.write(creds.to_json())
-        self.service = build('gmail', 'v1', credentials=creds)
-
-    def read_task_log(self):
-        log_file_path = os.path.join(self.path, 'gTasks_log.json')
-        if not os.path.exists(log_file_path):
-            return []
-        
-        with open(log_file_path, 'r') as log_file:
-            return [json.loads(line) for line in log_file]
-
-    def write_task_log(self, tasks):
-        log_file_path = os.path.join(self.path, 'gTasks_log.json')
-        with open(log_file_path, 'w') as log_file:
-            for task in tasks:
-                json.dump(task, log_file)
-                log_file.write('\n')
-
-    def create_google_task(self, task_name, due_date):
+        with self.metrics.timer('google_tasks.auth'):
+            _, self.service = get_service('tasks', 'v1', self.credentials_path, self.token_path, self.SCOPES)
+
+    def read_remote_state(self):
+        if not os.path.exists(self.remote_state_path):
+            return {'updated_min': None, 'tasks': {}}
+
+        with open(self.remote_state_path, 'r') as state_file:
+            return json.load(state_file)
+
+    def write_remote_state(self):
+        with open(self.remote_state_path, 'w') as state_file:
+            json.dump(self.remote_state, state_file)
+
+    def refresh_remote_tasks(self):
+        # Mirrors the task list locally; after the first full listing only tasks changed since the last run are fetched
+        self.remote_state = self.read_remote_state()
+        updated_min = self.remote_state['updated_min']
+        # Leave a margin for clock skew between this machine and Google
+        listed_at = datetime.datetime.utcnow() - datetime.timedelta(minutes=5)
+
+        page_token = None
+        while True:
+            self.metrics.incr('api_calls.tasks.list')
+            with self.metrics.timer('google_tasks.list'):
+                request = self.service.tasks().list(
+                    tasklist=self.tasklist, updatedMin=updated_min, showCompleted=True, showHidden=True,
+                    showDeleted=True, maxResults=100, pageToken=page_token
+                )
+                results = self.scheduler.call('tasks', request.execute)
+            for task in results.get('items', []):
+                self.remember_task(task)
+
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                break
+
+        self.remote_state['updated_min'] = listed_at.isoformat() + 'Z'
+        self.tasks_by_title = {task['title']: (task_id, task) for task_id, task in self.remote_state['tasks'].items()}
+
+    def remember_task(self, task):
+        # Deleted and completed tasks are kept so they are not created again
+        self.remote_state['tasks'][task['id']] = {
+            'title': task.get('title'),
+            'due': task.get('due'),
+            'status': task.get('status'),
+            'deleted': task.get('deleted', False)
+        }
+
+    def find_remote_task(self, task_name):
+        """Returns (task id, mirrored task) for a task this sink created, or (None, None)"""
+        # The ledger's id still finds a task after it was renamed in Google Tasks; older records only have the title
+        record = self.ledger.get(task_name)
+        task_id = record.get('google_task_id') if record else None
+        if task_id in self.remote_state['tasks']:
+            return task_id, self.remote_state['tasks'][task_id]
+        return self.tasks_by_title.get(task_name, (None, None))
+
+    def plan_google_task(self, task_name, due_date):
+        """Returns an insert or patch request for the task, or None if Google Tasks is already up to date"""
         current_time = datetime.datetime.utcnow()
         due_date_utc = due_date.replace(tzinfo=None)
 
         if due_date_utc <= current_time:
             print(f"Skipping '{task_name}' as its due date is in the past.")
-            return
-
-        tasks_log = self.read_task_log()
-        task_log_names = [task['task_name'] for task in tasks_log]
-
-        if task_name not in task_log_names:
-            due_rfc3339 = due_date_utc.isoformat() + 'Z'
-            task = {
-                'title': task_name,
-                'due': due_rfc3339
-            }
-            result = self.service.tasks().insert(tasklist='@default', body=task).execute()
-            print(f"Task created: {result['title']} with due date {result['due']}")
-
-            tasks_log.append({
-                'task_name': task_name,
-                'created_at': current_time.isoformat() + 'Z',
-                'due_date': due_rfc3339
-            })
-            self.write_task_log(tasks_log)
-        else:
-            print(f"Task '{task_name}' already exists. No new task created.")
+            self.metrics.incr('google_tasks.skipped_past_due')
+            return None
 
+        due_rfc3339 = due_date_utc.isoformat() + 'Z'
+        task_id, remote_task = self.find_remote_task(task_name)
+        if remote_task is None:
+            self.metrics.incr('api_calls.tasks.insert')
+            return self.service.tasks().insert(tasklist=self.tasklist, body={'title': task_name, 'due': due_rfc3339})
 
+        # Google Tasks keeps only the date part of a due date
+        if remote_task['deleted'] or remote_task['status'] == 'completed' or (remote_task['due'] or '')[:10] == due_rfc3339[:10]:
+            print(f"Task '{task_name}' already exists. No new task created.")
+            self.metrics.incr('google_tasks.duplicate')
+            return None
+
+        self.metrics.incr('api_calls.tasks.patch')
+        return self.service.tasks().patch(tasklist=self.tasklist, task=task_id, body={'due': due_rfc3339})
+
+    def execute_requests(self, requests_by_title):
+        """Sends {task title: request} as batch requests, resending only the parts that were throttled or failed"""
+        # Patches can be resent freely; inserts only when Google did not process them
+        results, errors = self.scheduler.execute_batches(
+            'tasks', requests_by_title, self.new_batch_request, self.BATCH_SIZE,
+            idempotent=lambda title: self.find_remote_task(title)[1] is not None,
+            timer='google_tasks.write', metrics=self.metrics
+        )
+        for title, error in errors.items():
+            print(f"Error syncing task '{title}':", error)
+            self.failures.record()
+        return results
+
+    def new_batch_request(self, callback):
+        return new_batch_request(self.service, callback, self.batch_uri)
 
     def sync_tasks(self):
-        tasks_log = self.read_task_log()
-        tasks_log = [task for task in tasks_log if datetime.datetime.strptime(task['due_date'], '%Y-%m-%dT%H:%M:%SZ') >= datetime.datetime.utcnow()]
-        self.write_task_log(tasks_log)
-        
-        for task_name, (course_name, due_datetime) in self.tasks.items():
-            full_task_name = f"{task_name} - {course_name}"
-            self.create_google_task(full_task_name, due_datetime) 
+        self.sync_stream((task_name, course_name, due_datetime) for task_name, (course_name, due_datetime) in self.tasks.items())
+
+    def sync_stream(self, assignments):
+        # Consumes (task_name, course_name, due_datetime) tuples as they are parsed
+        self.failures.reset()
+        if not self.service:
+            self.authenticate()
+        self.ledger.expire(datetime.datetime.utcnow())
+        self.refresh_remote_tasks()
+
+        pending_requests = {}  # task title -> request; a re-emitted task replaces its earlier request
+        try:
+            for task_name, course_name, due_datetime in assignments:
+                full_task_name = f"{task_name} - {course_name}"
+                request = self.plan_google_task(full_task_name, due_datetime)
+                if request is not None:
+                    pending_requests[full_task_name] = request
+                if len(pending_requests) == self.BATCH_SIZE:
+                    self.apply_requests(pending_requests)
+                    pending_requests = {}
+            if pending_requests:
+                self.apply_requests(pending_requests)
+        finally:
+            # Keep the tasks created so far in the mirror and ledger even when the stream was cut short
+            self.write_remote_state()
+            self.ledger.flush()
+        self.failures.raise_if_any()
+
+    def apply_requests(self, requests_by_title):
+        now = datetime.datetime.utcnow().isoformat() + 'Z'
+        for title, task in self.execute_requests(requests_by_title).items():
+            created = self.find_remote_task(title)[1] is None
+            self.remember_task(task)
+            self.tasks_by_title[title] = (task['id'], self.remote_state['tasks'][task['id']])
+            if created:
+                print(f"Task created: {task['title']} with due date {task['due']}")
+                self.metrics.incr('google_tasks.created')
+            else:
+                print(f"Due date of '{task['title']}' updated to {task['due']}")
+                self.metrics.incr('google_tasks.updated')
+
+            due_date = datetime.datetime.fromisoformat(task['due'].replace('Z', '')).replace(tzinfo=None)
+            self.ledger.add(title, due_date, {
+                'task_name': title,
+                'google_task_id': task['id'],
+                'synced_at': now,
+                'due_date': task['due']
+            })
 
 
 if __name__ == '__main__':
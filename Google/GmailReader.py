@@ -1,111 +1,379 @@
 import os.path
-import base64
 import datetime
-import re
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from google.auth.transport.requests import Request
-from googleapiclient.discovery import build
-from google.auth.exceptions import RefreshError
+import json
+from googleapiclient.errors import HttpError
+from Google.GoogleAuth import get_service, new_batch_request
+from Google.MessageBody import iter_message_bodies, part_fields
+from Google.ParsedEmailCache import ParsedEmailCache
+from Common.BrightspaceParser import PARSER_VERSION, parse_first_digest
+from Common.ParsePool import parse_bodies
+from Common.Metrics import run_metrics
+from Common.RequestScheduler import GMAIL_QUOTA_UNITS, CircuitOpenError, default_scheduler
+
+class BackfillStopped(Exception):
+    """Raised when a backfill stops early; the windows finished so far are checkpointed and a rerun resumes after them"""
+
 
 class GmailReader:
-    def __init__(self, credentials_path='client_secret.json', token_path='GmailToken.json'):
+    BATCH_SIZE = 50  # Gmail recommends no more than 50 calls per batch request
+    HISTORY_FALLBACK_DAYS = 7
+    DIGEST_MARKER = 'activity summary'
+    # Field masks: the triage pass needs only the subject, sender and snippet; the body pass only the MIME tree and part data
+    METADATA_HEADERS = ['Subject', 'From']
+    METADATA_FIELDS = 'id,snippet,payload/headers'
+    # Parts nest once per multipart or attached message, e.g. mixed > rfc822 > mixed > alternative > text/plain;
+    # a partial response drops anything deeper than the mask, so it goes well past what real mail uses
+    MAX_PART_DEPTH = 12
+    BODY_FIELDS = f'id,payload({part_fields(MAX_PART_DEPTH)})'
+
+    def __init__(self, credentials_path='client_secret.json', token_path='GmailToken.json', state_path='gmail_sync_state.json', use_cache=True, cache_path='parsed_emails.db', metrics=None, scheduler=None):
         path = os.path.dirname(os.path.abspath(__file__))
         self.credentials_path = os.path.join(path, credentials_path)
         self.token_path = os.path.join(path, token_path)
+        self.state_path = os.path.join(path, state_path)
+        self.pending_history_id = None
         self.service = None
+        self.creds = None
+        self.batch_uri = None  # See new_batch_request
         self.SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
         self.filteredEmails = []
         self.tasks = {}
+        self.cache = ParsedEmailCache(PARSER_VERSION, cache_path) if use_cache else None
+        self.metrics = metrics or run_metrics
+        self.scheduler = scheduler or default_scheduler
 
     def authenticate(self):
-        creds = None
-        if os.path.exists(self.token_path):
-            try:
-                creds = Credentials.from_authorized_user_file(self.token_path, self.SCOPES)
-            except Exception as e:
-                print("Error loading credentials:", e)
-                creds = None
-
-        if not creds or not creds.valid:
-            if creds and creds.expired and creds.refresh_token:
-                try:
-                    creds.refresh(Request())
-                except RefreshError:
-                    print("Token expired or revoked. Re-authenticating...")
-                    creds = None  # Set creds to None to trigger re-authentication
-            if not creds:
-                flow = InstalledAppFlow.from_client_secrets_file(self.credentials_path, self.SCOPES)
-                creds = flow.run_local_server(port=0)
-                with open(self.token_path, 'w') as token:
-                    token.write(creds.to_json())
-        self.service = build('gmail', 'v1', credentials=creds)
+        with self.metrics.timer('gmail.auth'):
+            self.creds, self.service = get_service('gmail', 'v1', self.credentials_path, self.token_path, self.SCOPES)
 
     def filter_messages(self, sender_email):
         if not self.service:
             print("You must authenticate before filtering messages.")
             return
 
+        found = False
+        for email_details in self.stream_messages(sender_email):
+            self.filteredEmails.append(email_details)
+            found = True
+
+        if not found:
+            print("No messages found.")
+
+    def stream_messages(self, sender_email):
+        # Yields messages batch by batch as the listing pages arrive, so callers can parse while fetching
+        if not self.service:
+            print("You must authenticate before filtering messages.")
+            return
+
         today = datetime.datetime.now().strftime('%Y/%m/%d')
-        query = f'from:{sender_email} after:{today}'
+        yield from self.stream_query(f'from:{sender_email} after:{today}')
+
+    def stream_new_messages(self, sender_email):
+        # Incremental variant of stream_messages driven by the historyId saved on the last successful run
+        if not self.service:
+            print("You must authenticate before filtering messages.")
+            return
 
-        results = self.service.users().messages().list(userId='me', q=query).execute()
-        messages = results.get('messages', [])
+        # Remember where the mailbox is before reading, so mail arriving mid-run is picked up next time
+        self.metrics.incr('api_calls.gmail.users.getProfile')
+        request = self.service.users().getProfile(userId='me')
+        profile = self.scheduler.call('gmail', request.execute, GMAIL_QUOTA_UNITS['getProfile'])
+        self.pending_history_id = profile['historyId']
 
-        if not messages:
-            print("No messages found.")
+        history_id = self.read_sync_state().get('history_id')
+        if history_id:
+            try:
+                message_ids = self.list_history_message_ids(history_id)
+            except HttpError as e:
+                if e.resp.status != 404:
+                    raise
+                print("History checkpoint expired. Falling back to a full query.")
+            else:
+                for email_details in self.stream_message_ids(message_ids):
+                    if 'assignments' in email_details or self.is_from_sender(email_details, sender_email):
+                        yield email_details
+                return
+
+        since = datetime.datetime.now() - datetime.timedelta(days=self.HISTORY_FALLBACK_DAYS)
+        yield from self.stream_query(f'from:{sender_email} after:{since.strftime("%Y/%m/%d")}')
+
+    def stream_query(self, query):
+        yield from self.stream_message_ids(self.list_message_ids(query))
+
+    def stream_message_ids(self, message_ids):
+        pending_ids = []
+        for message_id in message_ids:
+            pending_ids.append(message_id)
+            if len(pending_ids) == self.BATCH_SIZE:
+                yield from self.fetch_uncached_messages(pending_ids)
+                pending_ids = []
+        if pending_ids:
+            yield from self.fetch_uncached_messages(pending_ids)
+
+    def fetch_uncached_messages(self, message_ids):
+        # Messages parsed on an earlier run come back as {'id', 'assignments'} without touching the network
+        cached = self.cache.get_many(message_ids) if self.cache else {}
+        missing_ids = [message_id for message_id in message_ids if message_id not in cached]
+        if self.cache:
+            self.metrics.incr('gmail.cache.hits', len(cached))
+            self.metrics.incr('gmail.cache.misses', len(missing_ids))
+        fetched = {email['id']: email for email in self.fetch_messages(missing_ids)} if missing_ids else {}
+
+        for message_id in message_ids:
+            if message_id in cached:
+                yield {'id': message_id, 'assignments': cached[message_id]}
+            elif message_id in fetched:
+                yield fetched[message_id]
+
+    def list_message_ids(self, query):
+        page_token = None
+        while True:
+            self.metrics.incr('api_calls.gmail.messages.list')
+            with self.metrics.timer('gmail.list'):
+                request = self.service.users().messages().list(userId='me', q=query, pageToken=page_token)
+                results = self.scheduler.call('gmail', request.execute, GMAIL_QUOTA_UNITS['messages.list'])
+            for message in results.get('messages', []):
+                yield message['id']
+
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return
+
+    def list_history_message_ids(self, start_history_id):
+        message_ids = []
+        seen = set()
+        page_token = None
+        while True:
+            self.metrics.incr('api_calls.gmail.history.list')
+            with self.metrics.timer('gmail.history'):
+                request = self.service.users().history().list(
+                    userId='me', startHistoryId=start_history_id, historyTypes='messageAdded', pageToken=page_token
+                )
+                results = self.scheduler.call('gmail', request.execute, GMAIL_QUOTA_UNITS['history.list'])
+            for record in results.get('history', []):
+                for added in record.get('messagesAdded', []):
+                    message_id = added['message']['id']
+                    if message_id not in seen:
+                        seen.add(message_id)
+                        message_ids.append(message_id)
+
+            page_token = results.get('nextPageToken')
+            if not page_token:
+                return message_ids
+
+    def is_from_sender(self, email, sender_email):
+        for header in email['payload'].get('headers', []):
+            if header['name'].lower() == 'from':
+                return sender_email.lower() in header['value'].lower()
+        return False
+
+    def is_quota_error(self, error):
+        return isinstance(error, HttpError) and self.scheduler.is_quota_error(error)
+
+    def backfill(self, sender_email, start_date, end_date, window_days=7, workers=None):
+        # Walks [start_date, end_date) in fixed windows, yielding assignments like iter_assignments.
+        # Each finished window is checkpointed with its assignments, so a rerun skips it without fetching.
+        if not self.service:
+            print("You must authenticate before filtering messages.")
             return
 
-        for message in messages:
-            msg = self.service.users().messages().get(userId='me', id=message['id']).execute()
-            email_details = {'id': message['id'], 'snippet': msg['snippet']}
-            self.filteredEmails.append(email_details)
+        run_key = f"{sender_email}|{start_date:%Y-%m-%d}|{end_date:%Y-%m-%d}|{window_days}"
+        state = self.read_sync_state()
+        completed_windows = state.setdefault('backfill', {}).setdefault(run_key, {})
+
+        window_start = start_date
+        while window_start < end_date:
+            window_end = min(window_start + datetime.timedelta(days=window_days), end_date)
+            window_key = window_start.strftime('%Y-%m-%d')
+
+            if window_key in completed_windows:
+                window_assignments = [
+                    (task_name, course_name, datetime.datetime.fromisoformat(due_date))
+                    for task_name, course_name, due_date in completed_windows[window_key]
+                ]
+            else:
+                query = f'from:{sender_email} after:{window_start:%Y/%m/%d} before:{window_end:%Y/%m/%d}'
+                emails = self.stream_query(query)
+                parsed_emails = self.parse_emails_in_pool(emails, workers) if workers else self.parse_emails(emails)
+                try:
+                    window_assignments = [assignment for assignments in parsed_emails for assignment in assignments]
+                except HttpError as e:
+                    if not self.is_quota_error(e):
+                        raise
+                    raise BackfillStopped(f"Gmail quota exhausted in the window starting {window_key}. Run the backfill again to resume from here.") from e
+                except CircuitOpenError as e:
+                    raise BackfillStopped(f"Gmail is failing in the window starting {window_key} ({e}). Run the backfill again to resume from here.") from e
+
+                if self.cache:
+                    self.cache.commit()
+                print(f"Backfilled {window_key} to {window_end:%Y-%m-%d}: {len(window_assignments)} assignments.")
+                # A window that has not ended yet can still receive mail, so it is read again on the next run
+                if window_end <= datetime.datetime.now():
+                    completed_windows[window_key] = [
+                        [task_name, course_name, due_date.isoformat()] for task_name, course_name, due_date in window_assignments
+                    ]
+                    self.write_sync_state(state)
+
+            yield from self.merge_assignments(window_assignments)
+            window_start = window_end
+
+    def read_sync_state(self):
+        if not os.path.exists(self.state_path):
+            return {}
+
+        with open(self.state_path, 'r') as state_file:
+            return json.load(state_file)
+
+    def write_sync_state(self, state):
+        with open(self.state_path, 'w') as state_file:
+            json.dump(state, state_file)
+
+    def commit_checkpoint(self):
+        # Call once the run has been fully processed; the next stream_new_messages starts from here
+        if self.pending_history_id is None:
+            return
+
+        state = self.read_sync_state()
+        state['history_id'] = self.pending_history_id
+        self.write_sync_state(state)
+        self.pending_history_id = None
+
+    def fetch_messages(self, message_ids):
+        # Two passes, each grouped into batch requests: headers and snippet for every message, then the
+        # body only for the ones that look like Activity summary digests
+        metadata = self.batch_get(message_ids, format='metadata', metadataHeaders=self.METADATA_HEADERS, fields=self.METADATA_FIELDS)
+        digest_ids = [message_id for message_id in message_ids if message_id in metadata and self.is_digest(metadata[message_id])]
+        self.metrics.incr('gmail.triage.skipped', len(metadata) - len(digest_ids))
+        bodies = self.batch_get(digest_ids, format='full', fields=self.BODY_FIELDS) if digest_ids else {}
+
+        emails = []
+        for message_id in message_ids:
+            if message_id in bodies:
+                payload = bodies[message_id]['payload']
+                # Keep the headers from the first pass so callers can still check the sender
+                payload['headers'] = metadata[message_id]['payload'].get('headers', [])
+                emails.append({'id': message_id, 'snippet': metadata[message_id].get('snippet', ''), 'payload': payload})
+            elif message_id in metadata and message_id not in digest_ids:
+                # Not a digest: remember that, so the message is not triaged again on later runs
+                if self.cache:
+                    self.cache.put(message_id, [])
+                emails.append({'id': message_id, 'assignments': []})
+        return emails
+
+    def is_digest(self, message):
+        for header in message.get('payload', {}).get('headers', []):
+            if header['name'].lower() == 'subject' and self.DIGEST_MARKER in header['value'].lower():
+                return True
+        return self.DIGEST_MARKER in message.get('snippet', '').lower()
+
+    def batch_get(self, message_ids, **get_arguments):
+        """Returns {message_id: messages.get response}, resending only the throttled or failed parts of each batch"""
+        requests_by_id = {}
+        for message_id in message_ids:
+            requests_by_id[message_id] = self.service.users().messages().get(userId='me', id=message_id, **get_arguments)
+            self.metrics.incr('api_calls.gmail.messages.get')
+
+        # Quota exhaustion and outages that outlast the retries are raised instead of silently dropping messages,
+        # so backfills can resume later
+        fetched, errors = self.scheduler.execute_batches(
+            'gmail', requests_by_id, self.new_batch_request, self.BATCH_SIZE, GMAIL_QUOTA_UNITS['messages.get'],
+            stop_on=lambda error: self.scheduler.is_quota_error(error) or self.scheduler.is_retryable(error),
+            timer='gmail.get', metrics=self.metrics
+        )
+        for message_id, error in errors.items():
+            print(f"Error fetching message {message_id}:", error)
+        return fetched
+
+    def new_batch_request(self, callback):
+        return new_batch_request(self.service, callback, self.batch_uri)
 
     def get_message_body(self, message_id):
         if not self.service:
             print("You must authenticate before getting a message body.")
             return
 
-        message = self.service.users().messages().get(userId='me', id=message_id, format='full').execute()
+        return self.decode_message_body(self.get_message(message_id))
 
-        if 'parts' in message['payload']:
-            for part in message['payload']['parts']:
-                if part['mimeType'] == 'text/plain' or part['mimeType'] == 'text/html':
-                    data = part['body']['data']
-                    text = base64.urlsafe_b64decode(data.encode('ASCII')).decode('utf-8')
-                    return text
-        else:
-            # For simple email bodies (non-multipart)
-            data = message['payload']['body']['data']
-            text = base64.urlsafe_b64decode(data.encode('ASCII')).decode('utf-8')
-            return text
+    def get_message(self, message_id):
+        self.metrics.incr('api_calls.gmail.messages.get')
+        with self.metrics.timer('gmail.get'):
+            request = self.service.users().messages().get(userId='me', id=message_id, format='full', fields=self.BODY_FIELDS)
+            return self.scheduler.call('gmail', request.execute, GMAIL_QUOTA_UNITS['messages.get'])
 
+    def decode_message_body(self, message):
+        for lines in iter_message_bodies(message):
+            return ''.join(lines)
         return "No readable message body found."
     
-    def break_down_email(self):
-        for email in self.filteredEmails:
-            email_id = email['id']
-            email_body = self.get_message_body(email_id)
-            courseName = ""
-            taskName = ""
-            dueDate = ""
-            task_name_pattern = re.compile(r"^(.*?)<")
-
-            lines = email_body.split("\n")
-            for i in range(len(lines)):
-                lines[i] = lines[i].replace("FW: ", "")
-                parts = lines[i].split(' ')
-                if courseName == "" and "Activity summary for" in lines[i]:
-                    parts = parts[5:]
-                    courseName = "".join(parts[1:3])
-                elif "- Due date is in" in lines[i] and courseName != "":
-                    taskName = task_name_pattern.search(lines[i]).group(1).strip()
-                    clean_time_string = lines[i + 1].lstrip(": ").strip().replace("Due date: ", "")  # Strip whitespace from both ends
-                    try:
-                        dueDate = datetime.datetime.strptime(clean_time_string[:-4].strip(), "%A, %B %d, %Y %I:%M %p")
-                    except ValueError as e:
-                        print("Error parsing date:", e, "from string:", repr(clean_time_string))
-                    self.tasks[taskName] = (courseName, dueDate)
+    def break_down_email(self, emails=None):
+        # Accepts any iterable of messages, e.g. the stream_messages generator
+        for _ in self.iter_assignments(emails):
+            pass
+
+    def iter_assignments(self, emails=None, workers=None):
+        # Yields (task_name, course_name, due_date) whenever a task is new or its details changed.
+        # With workers set, bodies are parsed on a process pool; the merge order stays the message order.
+        if emails is None:
+            emails = self.filteredEmails
+
+        parsed_emails = self.parse_emails_in_pool(emails, workers) if workers else self.parse_emails(emails)
+        for assignments in parsed_emails:
+            yield from self.merge_assignments(assignments)
+
+        if self.cache:
+            self.cache.commit()
+
+    def merge_assignments(self, assignments):
+        for task_name, course_name, due_date in assignments:
+            if self.tasks.get(task_name) != (course_name, due_date):
+                self.tasks[task_name] = (course_name, due_date)
+                yield task_name, course_name, due_date
+
+    def get_email_bodies(self, email):
+        # Every candidate body as a string, for the process pool, which applies the same rule as parse_emails
+        message = email if 'payload' in email else self.get_message(email['id'])
+        return [''.join(lines) for lines in iter_message_bodies(message)]
+
+    def parse_emails(self, emails):
+        for email in emails:
+            if 'assignments' in email:
+                yield email['assignments']
+                continue
+
+            message = email if 'payload' in email else self.get_message(email['id'])
+            with self.metrics.timer('parse'):
+                # Bodies are decoded lazily, line by line; later candidates are tried when one yields no assignments
+                assignments = parse_first_digest(iter_message_bodies(message))
+            self.metrics.incr('gmail.emails.parsed')
+            if self.cache:
+                self.cache.put(email['id'], assignments)
+            yield assignments
+
+    def parse_emails_in_pool(self, emails, workers):
+        cached_assignments = {}
+
+        def bodies():
+            for email in emails:
+                if 'assignments' in email:
+                    cached_assignments[email['id']] = email['assignments']
+                    yield email['id'], None
+                else:
+                    yield email['id'], self.get_email_bodies(email)
+
+        for message_id, assignments in parse_bodies(bodies(), workers):
+            if assignments is None:
+                yield cached_assignments.pop(message_id)
+                continue
+
+            self.metrics.incr('gmail.emails.parsed')
+            if self.cache:
+                self.cache.put(message_id, assignments)
+            yield assignments
+
+    def close(self):
+        if self.cache:
+            self.cache.close()
+            self.cache = None
 
 
 # Usage example:
@@ -0,0 +1,64 @@
+import os
+from google.oauth2.credentials import Credentials
+from google.auth.transport.requests import Request
+from google.auth.exceptions import RefreshError
+from googleapiclient.discovery import build
+from googleapiclient.http import BatchHttpRequest
+
+# Shared by GmailReader and GCalendarTasks so a run loads, refreshes and builds each of these at most once
+_credentials = {}  # token path -> Credentials
+_services = {}  # (api name, version, token path) -> discovery Resource
+
+
+def get_credentials(credentials_path, token_path, scopes):
+    creds = _credentials.get(token_path)
+    if creds is not None and creds.valid:
+        return creds
+
+    creds = None
+    if os.path.exists(token_path):
+        try:
+            creds = Credentials.from_authorized_user_file(token_path, scopes)
+        except Exception as e:
+            print("Error loading credentials:", e)
+            creds = None
+
+    if not creds or not creds.valid:
+        if creds and creds.expired and creds.refresh_token:
+            try:
+                creds.refresh(Request())
+                # Save the new access token so the next run within the hour skips the refresh round trip
+                save_credentials(creds, token_path)
+            except RefreshError:
+                print("Token expired or revoked. Re-authenticating...")
+                creds = None  # Set creds to None to trigger re-authentication
+        if not creds:
+            # Only needed for the browser consent flow, which most runs never reach
+            from google_auth_oauthlib.flow import InstalledAppFlow
+            flow = InstalledAppFlow.from_client_secrets_file(credentials_path, scopes)
+            creds = flow.run_local_server(port=0)
+            save_credentials(creds, token_path)
+
+    _credentials[token_path] = creds
+    return creds
+
+
+def save_credentials(creds, token_path):
+    with open(token_path, 'w') as token:
+        token.write(creds.to_json())
+
+
+def get_service(api_name, version, credentials_path, token_path, scopes):
+    creds = get_credentials(credentials_path, token_path, scopes)
+    key = (api_name, version, token_path)
+    if key not in _services:
+        # The discovery document bundled with google-api-python-client; no network fetch, no file cache
+        _services[key] = build(api_name, version, credentials=creds, static_discovery=True, cache_discovery=False)
+    return creds, _services[key]
+
+
+def new_batch_request(service, callback, batch_uri=None):
+    # batch_uri overrides the discovery document's batch endpoint, e.g. for a local stand-in server
+    if batch_uri:
+        return BatchHttpRequest(callback=callback, batch_uri=batch_uri)
+    return service.new_batch_http_request(callback=callback)
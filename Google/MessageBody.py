@@ -0,0 +1,70 @@
+import base64
+import codecs
+import io
+
+# base64url characters decoded per step; a multiple of 4 so every chunk decodes on its own
+DECODE_CHUNK_SIZE = 64 * 1024
+
+
+def part_fields(depth):
+    """Partial-response field mask for a MIME tree up to depth levels of parts, keeping only each part's type and data"""
+    fields = 'mimeType,body/data'
+    for _ in range(depth):
+        fields = f'mimeType,body/data,parts({fields})'
+    return fields
+
+
+def iter_text_parts(payload):
+    """Yields the text/plain parts with data of a Gmail MIME tree in document order, then its text/html parts.
+
+    Nested multipart/alternative, multipart/mixed and forwarded message/rfc822 parts are all searched
+    without recursion. A forward-as-attachment has the forwarder's note first, so callers that need a
+    particular body should keep going past the first part.
+    """
+    html_parts = []
+    stack = [payload]
+    while stack:
+        part = stack.pop()
+        if part.get('parts'):
+            stack.extend(reversed(part['parts']))
+            continue
+        if not part.get('body', {}).get('data'):
+            continue
+
+        mime_type = part.get('mimeType', '').lower()
+        if mime_type == 'text/plain':
+            yield part
+        elif mime_type == 'text/html':
+            html_parts.append(part)
+    yield from html_parts
+
+
+def iter_decoded_lines(data, chunk_size=DECODE_CHUNK_SIZE):
+    """Decodes base64url data chunk by chunk and yields its UTF-8 text line by line, keeping line endings"""
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    # Pieces of a line that continues into the next chunk; joined once the line is complete
+    pending = []
+    for start in range(0, len(data), chunk_size):
+        chunk = data[start:start + chunk_size]
+        if start + chunk_size >= len(data):
+            chunk += '=' * (-len(chunk) % 4)
+        text = decoder.decode(base64.urlsafe_b64decode(chunk))
+        if '\n' not in text:
+            pending.append(text)
+            continue
+
+        lines = io.StringIO(text).readlines()
+        lines[0] = ''.join(pending) + lines[0]
+        pending = [] if lines[-1].endswith('\n') else [lines.pop()]
+        yield from lines
+
+    pending.append(decoder.decode(b'', final=True))
+    last_line = ''.join(pending)
+    if last_line:
+        yield last_line
+
+
+def iter_message_bodies(message):
+    """Yields a lazy line iterator for every readable body of a Gmail message resource, best candidate first"""
+    for part in iter_text_parts(message['payload']):
+        yield iter_decoded_lines(part['body']['data'])
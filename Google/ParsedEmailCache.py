@@ -0,0 +1,82 @@
+import os
+import datetime
+import json
+import sqlite3
+import time
+
+
+class ParsedEmailCache:
+    SQLITE_MAX_VARIABLES = 500
+
+    def __init__(self, parser_version, cache_path='parsed_emails.db', max_entries=5000, max_age_days=180):
+        path = os.path.dirname(os.path.abspath(__file__))
+        self.cache_path = os.path.join(path, cache_path)
+        self.parser_version = parser_version
+        self.max_entries = max_entries
+        self.max_age_seconds = max_age_days * 24 * 60 * 60
+        # AsyncGmailReader parses on worker threads; it never uses the cache from two threads at once
+        self.connection = sqlite3.connect(self.cache_path, check_same_thread=False)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS parsed_emails ('
+            'message_id TEXT PRIMARY KEY, '
+            'parser_version INTEGER NOT NULL, '
+            'cached_at REAL NOT NULL, '
+            'assignments TEXT NOT NULL)'
+        )
+        self.connection.execute('CREATE INDEX IF NOT EXISTS parsed_emails_cached_at ON parsed_emails (cached_at)')
+        self.connection.commit()
+
+    def get_many(self, message_ids):
+        """Returns {message_id: assignments} for every id cached under the current parser version"""
+        cached = {}
+        for start in range(0, len(message_ids), self.SQLITE_MAX_VARIABLES):
+            chunk = message_ids[start:start + self.SQLITE_MAX_VARIABLES]
+            placeholders = ','.join('?' * len(chunk))
+            rows = self.connection.execute(
+                f'SELECT message_id, assignments FROM parsed_emails '
+                f'WHERE parser_version = ? AND message_id IN ({placeholders})',
+                [self.parser_version, *chunk]
+            )
+            for message_id, assignments in rows:
+                cached[message_id] = self.decode_assignments(assignments)
+        return cached
+
+    def put(self, message_id, assignments):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO parsed_emails (message_id, parser_version, cached_at, assignments) VALUES (?, ?, ?, ?)',
+            (message_id, self.parser_version, time.time(), self.encode_assignments(assignments))
+        )
+
+    def evict(self):
+        # Drop entries from older parser versions or past max age, then trim the oldest beyond max_entries
+        self.connection.execute(
+            'DELETE FROM parsed_emails WHERE parser_version != ? OR cached_at < ?',
+            (self.parser_version, time.time() - self.max_age_seconds)
+        )
+        self.connection.execute(
+            'DELETE FROM parsed_emails WHERE message_id IN '
+            '(SELECT message_id FROM parsed_emails ORDER BY cached_at DESC LIMIT -1 OFFSET ?)',
+            (self.max_entries,)
+        )
+
+    def commit(self):
+        self.connection.commit()
+
+    def close(self):
+        self.evict()
+        self.connection.commit()
+        self.connection.close()
+
+    @staticmethod
+    def encode_assignments(assignments):
+        return json.dumps([
+            [task_name, course_name, due_date.isoformat() if isinstance(due_date, datetime.datetime) else due_date]
+            for task_name, course_name, due_date in assignments
+        ])
+
+    @staticmethod
+    def decode_assignments(data):
+        return [
+            (task_name, course_name, datetime.datetime.fromisoformat(due_date) if due_date else due_date)
+            for task_name, course_name, due_date in json.loads(data)
+        ]
@@ -1,26 +1,177 @@
-from Google.GmailReader import GmailReader
-from Google.GCalendarTasks import GCalendarTasks
-from Todoist.TodoistTasks import TodoistTasks
-from Constants import EMAIL, GCAL_SYNC, TODOIST_SYNC
+import argparse
+import datetime
+import itertools
+import os
+from Google.GmailReader import BackfillStopped, GmailReader
+from Common.Pipeline import SyncPipeline
+from Common.Metrics import run_metrics
+from Common.SyncDaemon import AdaptivePollInterval, SyncDaemon
+from Common.AccountRunner import AccountRunner, load_accounts
+from Constants import (EMAIL, GCAL_SYNC, TODOIST_SYNC, GMAIL_INCREMENTAL_SYNC, METRICS_REPORT_PATH, PROMETHEUS_TEXTFILE_PATH,
+                       DAEMON_MIN_INTERVAL, DAEMON_MAX_INTERVAL, DAEMON_DIGEST_HOURS, DAEMON_LEARNED_HOUR_DAYS, DAEMON_WEBHOOK_PORT,
+                       PROJECT_NAME, SECTION_NAME, ACCOUNTS_FILE, ACCOUNTS_DIR)
 
 
+def parse_date(value):
+    return datetime.datetime.strptime(value, '%Y-%m-%d')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Sync Brightspace assignments from Gmail to Google Tasks and Todoist")
+    parser.add_argument('--backfill', nargs=2, type=parse_date, metavar=('START', 'END'),
+                        help="pull assignments from emails received between START and END (YYYY-MM-DD); resumes where an earlier run stopped")
+    parser.add_argument('--window-days', type=int, default=7, help="size of each backfill window in days")
+    parser.add_argument('--workers', type=int, default=None, help="parse backfilled emails on this many processes")
+    parser.add_argument('--daemon', action='store_true', help="keep running and poll Gmail history for new assignments")
+    parser.add_argument('--accounts', nargs='?', const=ACCOUNTS_FILE, metavar='PATH',
+                        help=f"sync every account listed in this JSON file (default {ACCOUNTS_FILE}) instead of the single user in Constants")
+    parser.add_argument('--account-workers', type=int, default=4, help="number of accounts synced in parallel")
+    return parser.parse_args()
+
+
+def export_metrics():
+    base_path = os.path.dirname(os.path.abspath(__file__))
+    if METRICS_REPORT_PATH:
+        run_metrics.write_json(os.path.join(base_path, METRICS_REPORT_PATH))
+    if PROMETHEUS_TEXTFILE_PATH:
+        run_metrics.write_prometheus(os.path.join(base_path, PROMETHEUS_TEXTFILE_PATH))
 
-if __name__ == '__main__':
-    reader = GmailReader()
-    reader.authenticate()
 
-    reader.filter_messages(EMAIL)
-    reader.break_down_email()
+def build_sinks(reader, account=None):
+    # Sinks are imported only when enabled, so a disabled one costs nothing at startup
+    sinks = {}
+    if account is None:
+        if GCAL_SYNC:
+            from Google.GCalendarTasks import GCalendarTasks
+            sinks['Google Calendar'] = GCalendarTasks(reader.tasks)
+        if TODOIST_SYNC:
+            from Todoist.TodoistTasks import TodoistTasks
+            sinks['Todoist'] = TodoistTasks(reader.tasks)
+        return sinks
+
+    if account.gcal_sync:
+        from Google.GCalendarTasks import GCalendarTasks
+        sinks['Google Calendar'] = GCalendarTasks(
+            reader.tasks,
+            token_path=account.path('TasksToken.json'),
+            log_file_path=account.path('gTasks_ledger.jsonl'),
+            legacy_log_file_path=account.path('gTasks_log.json'),
+            remote_state_path=account.path('gTasks_remote.json'),
+            metrics=account.metrics,
+            scheduler=account.scheduler
+        )
+    if account.todoist_sync:
+        from Todoist.TodoistTasks import TodoistTasks
+        sinks['Todoist'] = TodoistTasks(
+            reader.tasks,
+            log_file_path=account.path('todoist_tasks_ledger.jsonl'),
+            legacy_log_file_path=account.path('todoist_tasks_log.json'),
+            ids_cache_path=account.path('todoist_ids_cache.json'),
+            api_token=account.get_todoist_token(),
+            project_name=account.project_name,
+            section_name=account.section_name,
+            metrics=account.metrics,
+            scheduler=account.scheduler
+        )
+    return sinks
+
+
+def sync(reader, sinks, assignments):
+    """Runs the sinks over assignments; returns {sink name: None or error}, or None if there was nothing to sync"""
+    first = next(assignments, None)
+    if first is None:
+        # Nothing new: leave the sinks (and their APIs) alone, but still move the checkpoint forward
+        print("No new assignments.")
+        reader.commit_checkpoint()
+        return None
+
+    # Sinks consume assignments concurrently while Gmail is still being read
+    results = SyncPipeline(sinks, metrics=reader.metrics).run(itertools.chain([first], assignments))
 
     # print("Tasks: ", reader.tasks)
 
-    if GCAL_SYNC:
-        calendar_tasks = GCalendarTasks(reader.tasks)
-        calendar_tasks.authenticate()
-        calendar_tasks.sync_tasks()
-        print("Tasks synced to Google Calendar!")
+    for name, error in results.items():
+        if error is None:
+            print(f"Tasks synced to {name}!")
+
+    # Keep the checkpoint where it was if any sink failed, so its tasks are picked up again next run
+    if all(error is None for error in results.values()):
+        reader.commit_checkpoint()
+    return results
+
 
-    if TODOIST_SYNC:
-        todoist_tasks = TodoistTasks(reader.tasks)
-        todoist_tasks.sync_tasks()
-        print("Tasks synced to Todoist!")
+def sync_account(account):
+    reader = GmailReader(
+        token_path=account.path('GmailToken.json'),
+        state_path=account.path('gmail_sync_state.json'),
+        cache_path=account.path('parsed_emails.db'),
+        metrics=account.metrics,
+        scheduler=account.scheduler
+    )
+    try:
+        reader.authenticate()
+        sinks = build_sinks(reader, account)
+        return sync(reader, sinks, reader.iter_assignments(reader.stream_new_messages(account.email)))
+    finally:
+        reader.close()
+
+
+def run_accounts(accounts_path, workers):
+    base_path = os.path.dirname(os.path.abspath(__file__))
+    defaults = {
+        'email': EMAIL,
+        'project_name': PROJECT_NAME,
+        'section_name': SECTION_NAME,
+        'gcal_sync': GCAL_SYNC,
+        'todoist_sync': TODOIST_SYNC,
+    }
+    accounts = load_accounts(os.path.join(base_path, accounts_path), os.path.join(base_path, ACCOUNTS_DIR), defaults)
+    runner = AccountRunner(sync_account, workers)
+    runner.print_summary(runner.run(accounts))
+
+
+def run_daemon(reader, sinks):
+    # Reader, sinks, credentials and services stay warm between checks
+    def sync_once():
+        # Each check is reported on its own, and re-reads tasks from scratch so a cycle whose sinks
+        # failed is delivered again when the held-back checkpoint returns the same messages
+        run_metrics.reset()
+        reader.tasks.clear()
+        results = sync(reader, sinks, reader.iter_assignments(reader.stream_new_messages(EMAIL)))
+        export_metrics()
+        return results is not None
+
+    poll_interval = AdaptivePollInterval(DAEMON_MIN_INTERVAL, DAEMON_MAX_INTERVAL, DAEMON_DIGEST_HOURS, learned_days=DAEMON_LEARNED_HOUR_DAYS)
+    SyncDaemon(sync_once, poll_interval, DAEMON_WEBHOOK_PORT).run()
+
+
+def run_single(args):
+    reader = GmailReader()
+    reader.authenticate()
+    sinks = build_sinks(reader)
+
+    if args.daemon:
+        run_daemon(reader, sinks)
+    else:
+        if args.backfill:
+            start_date, end_date = args.backfill
+            assignments = reader.backfill(EMAIL, start_date, end_date, args.window_days, args.workers)
+        elif GMAIL_INCREMENTAL_SYNC:
+            assignments = reader.iter_assignments(reader.stream_new_messages(EMAIL))
+        else:
+            assignments = reader.iter_assignments(reader.stream_messages(EMAIL))
+        try:
+            sync(reader, sinks, assignments)
+        except BackfillStopped as e:
+            # The sinks have seen an incomplete stream, so they did not treat it as the full set of assignments
+            print(e)
+        export_metrics()
+    reader.close()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.accounts:
+        run_accounts(args.accounts, args.account_workers)
+    else:
+        run_single(args)
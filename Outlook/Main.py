@@ -1,7 +1,13 @@
 import asyncio
 import configparser
+import os
+import sys
 from msgraph.generated.models.o_data_errors.o_data_error import ODataError
-from graph import Graph
+
+# Run from this folder; the parser and settings live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from graph import Graph, GraphFetchError
+from Constants import EMAIL
 
 
 async def greet_user(graph: Graph):
@@ -13,8 +19,18 @@ async def display_access_token(graph: Graph):
     return
 
 async def list_inbox(graph: Graph):
-    # TODO
-    return
+    try:
+        assignments = await graph.get_assignments(EMAIL)
+    except GraphFetchError as e:
+        # Keep the old delta link, so the next listing returns these messages again
+        print(f'{e}. Try again later.\n')
+        return
+    if not assignments:
+        print('No new assignments.\n')
+    for task_name, course_name, due_date in assignments:
+        print(f'{task_name} - {course_name}: due {due_date}')
+    print()
+    graph.commit_delta_link()
 
 async def send_mail(graph: Graph):
     # TODO
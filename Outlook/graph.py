@@ -1,5 +1,11 @@
+import asyncio
+import datetime
+import json
+import os
+import time
+import httpx
 from configparser import SectionProxy
-from azure.identity import DeviceCodeCredential
+from azure.identity import AuthenticationRecord, AuthenticationRequiredError, DeviceCodeCredential, TokenCachePersistenceOptions
 from msgraph import GraphServiceClient
 from msgraph.generated.users.item.user_item_request_builder import UserItemRequestBuilder
 from msgraph.generated.users.item.mail_folders.item.messages.messages_request_builder import (
@@ -11,24 +17,221 @@ from msgraph.generated.models.item_body import ItemBody
 from msgraph.generated.models.body_type import BodyType
 from msgraph.generated.models.recipient import Recipient
 from msgraph.generated.models.email_address import EmailAddress
+from msgraph.generated.users.item.mail_folders.item.messages.delta.delta_request_builder import DeltaRequestBuilder
+from kiota_abstractions.base_request_configuration import RequestConfiguration
+from Common.BrightspaceParser import parse_activity_summary
+from Common.RequestScheduler import default_scheduler
+
+GRAPH_BATCH_URL = 'https://graph.microsoft.com/v1.0/$batch'
+GRAPH_BATCH_SIZE = 20  # Graph accepts at most 20 requests per $batch
+
+# The delta listing only carries what is needed to pick Brightspace mail; bodies are fetched in batches afterwards
+INBOX_SELECT = ['id', 'subject', 'from', 'receivedDateTime']
+BODY_SELECT = 'id,subject,from,receivedDateTime,body'
+
+
+class GraphFetchError(Exception):
+    """Raised when some message bodies could not be fetched; the delta link must not move past them"""
 
 class Graph:
     settings: SectionProxy
     device_code_credential: DeviceCodeCredential
     user_client: GraphServiceClient
 
-    def __init__(self, config: SectionProxy):
+    def __init__(self, config: SectionProxy, state_path: str = 'outlook_sync_state.json', auth_record_path: str = 'outlook_auth_record.json', scheduler=None):
         self.settings = config
+        self.scheduler = scheduler or default_scheduler
+        path = os.path.dirname(os.path.abspath(__file__))
+        self.state_path = os.path.join(path, state_path)
+        self.auth_record_path = os.path.join(path, auth_record_path)
+        self.pending_delta_link = None
+        self.access_token = None
         client_id = self.settings['clientId']
         tenant_id = self.settings['tenantId']
-        graph_scopes = self.settings['graphUserScopes'].split(' ')
+        self.graph_scopes = self.settings['graphUserScopes'].split(' ')
+
+        # Tokens persist in MSAL's cache, encrypted by the OS keyring (Keychain, DPAPI or libsecret). The saved
+        # authentication record names the cached account, so later runs refresh silently instead of asking for a device code.
+        cache_options = TokenCachePersistenceOptions(
+            name='sync_assignments_outlook',
+            allow_unencrypted_storage=self.settings.getboolean('allowUnencryptedTokenCache', fallback=False)
+        )
+        self.authentication_record = self.read_authentication_record()
+        self.device_code_credential = DeviceCodeCredential(
+            client_id,
+            tenant_id = tenant_id,
+            cache_persistence_options=cache_options,
+            authentication_record=self.authentication_record,
+            disable_automatic_authentication=True
+        )
+        self.user_client = GraphServiceClient(self.device_code_credential, self.graph_scopes)
+
+    def read_authentication_record(self):
+        if not os.path.exists(self.auth_record_path):
+            return None
 
-        self.device_code_credential = DeviceCodeCredential(client_id, tenant_id = tenant_id)
-        self.user_client = GraphServiceClient(self.device_code_credential, graph_scopes)
+        with open(self.auth_record_path, 'r') as record_file:
+            return AuthenticationRecord.deserialize(record_file.read())
+
+    async def sign_in(self):
+        # Interactive device code login; only needed on the first run or after the refresh token is revoked
+        self.authentication_record = await asyncio.to_thread(self.device_code_credential.authenticate, scopes=self.graph_scopes)
+        with open(self.auth_record_path, 'w') as record_file:
+            record_file.write(self.authentication_record.serialize())
+
+    async def ensure_signed_in(self):
+        if self.authentication_record is None:
+            await self.sign_in()
 
     async def get_user_token(self):
-        graph_scopes = self.settings['graphUserScopes']
-        access_token = self.device_code_credential.get_token(graph_scopes)
-        return access_token.token
+        # Reuse the access token until shortly before it expires; MSAL's cache and refresh calls block, so they run in a thread
+        if self.access_token is None or self.access_token.expires_on - 300 < time.time():
+            await self.ensure_signed_in()
+            try:
+                self.access_token = await asyncio.to_thread(self.device_code_credential.get_token, *self.graph_scopes)
+            except AuthenticationRequiredError:
+                await self.sign_in()
+                self.access_token = await asyncio.to_thread(self.device_code_credential.get_token, *self.graph_scopes)
+        return self.access_token.token
+
+    async def get_inbox_delta(self, since_days: int = 7):
+        # Resumes from the delta link saved by the last successful run, so an unchanged inbox costs one small call.
+        # The first run lists messages received in the last since_days days.
+        # The SDK asks the credential for tokens itself, which must not fall back to an interactive prompt
+        await self.get_user_token()
+        inbox_delta = self.user_client.me.mail_folders.by_mail_folder_id('inbox').messages.delta
+        delta_link = self.read_sync_state().get('delta_link')
+        if delta_link:
+            request = inbox_delta.with_url(delta_link)
+            request_configuration = RequestConfiguration()
+        else:
+            since = datetime.datetime.utcnow() - datetime.timedelta(days=since_days)
+            request = inbox_delta
+            request_configuration = RequestConfiguration(
+                query_parameters=DeltaRequestBuilder.DeltaRequestBuilderGetQueryParameters(
+                    select=INBOX_SELECT,
+                    filter=f"receivedDateTime ge {since:%Y-%m-%dT%H:%M:%SZ}",
+                    change_type='created'
+                )
+            )
+
+        response = await request.get(request_configuration)
+        while response is not None:
+            for message in response.value or []:
+                yield message
+            if not response.odata_next_link:
+                self.pending_delta_link = response.odata_delta_link
+                return
+            # Next links already carry $select and $filter
+            response = await inbox_delta.with_url(response.odata_next_link).get()
+
+    async def get_assignments(self, sender_email: str):
+        message_ids = []
+        async for message in self.get_inbox_delta():
+            if self.is_from_sender(message, sender_email):
+                message_ids.append(message.id)
+
+        messages = await self.fetch_messages(message_ids)
+        assignments = []
+        for message_id in message_ids:
+            body = (messages.get(message_id, {}).get('body') or {}).get('content')
+            if body:
+                assignments.extend(parse_activity_summary(body))
+        return assignments
+
+    async def fetch_messages(self, message_ids: list[str], max_concurrency: int = 4, expand_attachments: bool = False):
+        """Returns {message id: message JSON with a plain text body}, fetched through $batch requests of up to 20 GETs.
+
+        Raises GraphFetchError if any message could not be fetched.
+        """
+        # Outlook allows 4 concurrent requests per mailbox, so that is the default number of batches in flight
+        semaphore = asyncio.Semaphore(max_concurrency)
+        messages = {}
+        failed_ids = []
+        async with httpx.AsyncClient(timeout=60) as client:
+            await asyncio.gather(*(
+                self.fetch_batch(client, semaphore, message_ids[start:start + GRAPH_BATCH_SIZE], messages, failed_ids, expand_attachments)
+                for start in range(0, len(message_ids), GRAPH_BATCH_SIZE)
+            ))
+        if failed_ids:
+            raise GraphFetchError(f"{len(failed_ids)} of {len(message_ids)} messages could not be fetched")
+        return messages
+
+    async def fetch_batch(self, client: httpx.AsyncClient, semaphore: asyncio.Semaphore, message_ids: list[str], messages: dict, failed_ids: list, expand_attachments: bool):
+        query = f'$select={BODY_SELECT}'
+        if expand_attachments:
+            query += '&$expand=attachments($select=id,name,contentType,size)'
+
+        pending_ids = message_ids
+        attempt = 0
+        while pending_ids:
+            batch = {'requests': [
+                {'id': str(position), 'method': 'GET', 'url': f'/me/messages/{message_id}?{query}',
+                 'headers': {'Prefer': 'outlook.body-content-type="text"'}}
+                for position, message_id in enumerate(pending_ids)
+            ]}
+
+            async def post_batch():
+                async with semaphore:
+                    response = await client.post(GRAPH_BATCH_URL, json=batch, headers={'Authorization': f'Bearer {await self.get_user_token()}'})
+                response.raise_for_status()
+                return response.json()
+
+            # Throttling of the whole $batch call is retried by the scheduler; each item also carries its own status
+            result = await self.scheduler.call_async('graph', post_batch, len(pending_ids))
+
+            throttled_ids = []
+            retry_after = 0.0
+            for item in result.get('responses', []):
+                message_id = pending_ids[int(item['id'])]
+                if item['status'] == 200:
+                    messages[message_id] = item['body']
+                elif item['status'] in (429, 503, 504):
+                    throttled_ids.append(message_id)
+                    headers = {name.lower(): value for name, value in (item.get('headers') or {}).items()}
+                    retry_after = max(retry_after, float(headers.get('retry-after', 0)))
+                elif item['status'] == 404:
+                    # Deleted since it was listed; holding the delta link back would not bring it back
+                    print(f"Message {message_id} no longer exists.")
+                else:
+                    print(f"Error fetching message {message_id}: {item['status']} {item.get('body')}")
+                    failed_ids.append(message_id)
+
+            if not throttled_ids:
+                return
+            if attempt >= self.scheduler.max_retries:
+                print(f"Giving up on {len(throttled_ids)} throttled messages.")
+                failed_ids.extend(throttled_ids)
+                return
+            delay = retry_after or self.scheduler.base_delay * 2 ** attempt
+            self.scheduler.metrics.incr('retries')
+            self.scheduler.metrics.incr('retries.graph')
+            print(f"{len(throttled_ids)} Graph batch items throttled. Retrying in {delay:.1f}s...")
+            await asyncio.sleep(delay)
+            pending_ids = throttled_ids
+            attempt += 1
+
+    @staticmethod
+    def is_from_sender(message: Message, sender_email: str):
+        # Delta queries can only filter on receivedDateTime, so the sender is checked here
+        if message.from_ is None or message.from_.email_address is None:
+            return False
+        return sender_email.lower() in (message.from_.email_address.address or '').lower()
+
+    def read_sync_state(self):
+        if not os.path.exists(self.state_path):
+            return {}
+
+        with open(self.state_path, 'r') as state_file:
+            return json.load(state_file)
 
+    def commit_delta_link(self):
+        # Call once the messages have been processed; the next get_inbox_delta starts from here
+        if self.pending_delta_link is None:
+            return
 
+        state = self.read_sync_state()
+        state['delta_link'] = self.pending_delta_link
+        with open(self.state_path, 'w') as state_file:
+            json.dump(state, state_file)
+        self.pending_delta_link = None
@@ -1,18 +1,38 @@
 import os
 import datetime
 import json
+import uuid
+import requests
 from todoist_api_python.api import TodoistAPI
-from Constants import PROJECT_NAME, SECTION_NAME
+from Constants import PROJECT_NAME, SECTION_NAME, TODOIST_BULK_SYNC, TODOIST_RECONCILE, TODOIST_RECONCILE_CLOSE
+from Common.SyncLedger import SyncLedger
+from Common.Metrics import run_metrics
+from Common.Pipeline import SinkFailures
+from Common.RequestScheduler import CircuitOpenError, default_scheduler
+
+SYNC_API_URL = 'https://api.todoist.com/api/v1/sync'
 
 class TodoistTasks:
-    def __init__(self, tasks, log_file_path='todoist_tasks_log.json'):
+    SYNC_BATCH_SIZE = 100  # Todoist accepts at most 100 commands per sync request
+    COMPLETED_LOOKBACK = datetime.timedelta(days=89)  # The completed-tasks endpoint accepts at most a 3 month range
+    ID_CACHE_TTL = datetime.timedelta(days=7)
+
+    def __init__(self, tasks, log_file_path='todoist_tasks_ledger.jsonl', legacy_log_file_path='todoist_tasks_log.json', sync_url=SYNC_API_URL, ids_cache_path='todoist_ids_cache.json', api_token=None, project_name=PROJECT_NAME, section_name=SECTION_NAME, metrics=None, scheduler=None):
         self.tasks = tasks
+        self.sync_url = sync_url
         self.path = os.path.dirname(os.path.abspath(__file__))
-        self.api_token = self.get_api_token()
+        self.api_token = api_token or self.get_api_token()
         self.api = TodoistAPI(self.api_token)
         self.log_file_path = os.path.join(self.path, log_file_path)
+        self.ledger = SyncLedger(self.log_file_path, legacy_log_path=os.path.join(self.path, legacy_log_file_path))
+        self.ids_cache_path = os.path.join(self.path, ids_cache_path)
+        self.project_name = project_name
+        self.section_name = section_name
         self.project_id = None
         self.section_id = None
+        self.metrics = metrics or run_metrics
+        self.scheduler = scheduler or default_scheduler
+        self.failures = SinkFailures('Todoist', 'todoist.failed', self.metrics)
 
     def get_api_token(self):
         try:
@@ -79,9 +99,9 @@ class TodoistTasks:
             return []
 
     def get_project_id(self, project_name):
+        self.metrics.incr('api_calls.todoist.projects.list')
         try:
-            projects_paginator = self.api.get_projects()
-            projects_data = list(projects_paginator)  # Convert paginator to list
+            projects_data = self.scheduler.call('todoist', lambda: list(self.api.get_projects()))  # Convert paginator to list
             
             # Handle case where paginator returns a list containing a list of projects
             if len(projects_data) == 1 and isinstance(projects_data[0], list):
@@ -99,9 +119,9 @@ class TodoistTasks:
         return None
 
     def get_section_id(self, project_id, section_name):
+        self.metrics.incr('api_calls.todoist.sections.list')
         try:
-            sections_paginator = self.api.get_sections(project_id=project_id)
-            sections_data = list(sections_paginator)  # Convert paginator to list
+            sections_data = self.scheduler.call('todoist', lambda: list(self.api.get_sections(project_id=project_id)))  # Convert paginator to list
             
             # Handle case where paginator returns a list containing a list of sections
             if len(sections_data) == 1 and isinstance(sections_data[0], list):
@@ -118,17 +138,6 @@ class TodoistTasks:
             print(f"An error occurred while fetching sections: {e}")
         return None
 
-    def read_task_log(self):
-        if not os.path.exists(self.log_file_path):
-            return []
-        
-        with open(self.log_file_path, 'r') as log_file:
-            return json.load(log_file)
-
-    def write_task_log(self, tasks_log):
-        with open(self.log_file_path, 'w') as log_file:
-            json.dump(tasks_log, log_file)
-
     def debug_sync_setup(self):
         """Debug method to check project and section setup"""
         print("=== DEBUGGING TODOIST SETUP ===")
@@ -137,8 +146,8 @@ class TodoistTasks:
         projects = self.list_all_projects()
         
         # Try to find our target project
-        self.project_id = self.get_project_id(PROJECT_NAME)
-        print(f"\nLooking for project: '{PROJECT_NAME}'")
+        self.project_id = self.get_project_id(self.project_name)
+        print(f"\nLooking for project: '{self.project_name}'")
         print(f"Found project ID: {self.project_id}")
         
         if self.project_id:
@@ -146,79 +155,403 @@ class TodoistTasks:
             self.list_all_sections(self.project_id)
             
             # Try to find our target section
-            self.section_id = self.get_section_id(self.project_id, SECTION_NAME)
-            print(f"\nLooking for section: '{SECTION_NAME}'")
+            self.section_id = self.get_section_id(self.project_id, self.section_name)
+            print(f"\nLooking for section: '{self.section_name}'")
             print(f"Found section ID: {self.section_id}")
         else:
-            print(f"ERROR: Project '{PROJECT_NAME}' not found!")
+            print(f"ERROR: Project '{self.project_name}' not found!")
         
         print("=== END DEBUG ===\n")
 
-    def add_task(self, task_name, course_name, due_datetime):
+    @staticmethod
+    def parse_due_datetime(due_datetime):
         # Handle both string and datetime objects
         if isinstance(due_datetime, str):
-            due_date = datetime.datetime.strptime(due_datetime, '%Y-%m-%dT%H:%M:%S')
-            due_date_string = due_datetime
+            return datetime.datetime.strptime(due_datetime, '%Y-%m-%dT%H:%M:%S'), due_datetime
+        return due_datetime, due_datetime.strftime('%Y-%m-%dT%H:%M:%S')
+
+    def resolve_ids(self):
+        if self.project_id is None or self.section_id is None:
+            self.load_cached_ids()
+            if self.project_id is not None and self.section_id is not None:
+                self.metrics.incr('todoist.ids_cache.hits')
+        if self.project_id is None or self.section_id is None:
+            self.metrics.incr('todoist.ids_cache.misses')
+            if self.project_id is None:
+                self.project_id = self.get_project_id(self.project_name)
+            if self.section_id is None:
+                self.section_id = self.get_section_id(self.project_id, self.section_name)
+            self.save_cached_ids()
+
+    def load_cached_ids(self):
+        # Reuse the name -> id mapping from an earlier run while it is younger than ID_CACHE_TTL
+        if not os.path.exists(self.ids_cache_path):
+            return
+        try:
+            with open(self.ids_cache_path, 'r') as cache_file:
+                cache = json.load(cache_file)
+            resolved_at = datetime.datetime.fromisoformat(cache['resolved_at'])
+        except (ValueError, KeyError) as e:
+            print(f"Ignoring unreadable Todoist id cache: {e}")
+            return
+
+        if cache.get('project_name') != self.project_name or cache.get('section_name') != self.section_name:
+            return
+        if datetime.datetime.now() - resolved_at > self.ID_CACHE_TTL:
+            return
+        self.project_id = cache['project_id']
+        self.section_id = cache['section_id']
+
+    def save_cached_ids(self):
+        if self.project_id is None or self.section_id is None:
+            return
+        with open(self.ids_cache_path, 'w') as cache_file:
+            json.dump({
+                'project_name': self.project_name,
+                'section_name': self.section_name,
+                'project_id': self.project_id,
+                'section_id': self.section_id,
+                'resolved_at': datetime.datetime.now().isoformat()
+            }, cache_file)
+
+    def refresh_ids(self):
+        # Called when Todoist rejects a write because the cached project or section no longer exists
+        print("Cached Todoist project/section ids are stale. Resolving them again.")
+        if os.path.exists(self.ids_cache_path):
+            os.remove(self.ids_cache_path)
+        self.project_id = None
+        self.section_id = None
+        self.project_id = self.get_project_id(self.project_name)
+        self.section_id = self.get_section_id(self.project_id, self.section_name)
+        self.save_cached_ids()
+
+    @staticmethod
+    def error_details(error):
+        # REST errors carry Todoist's JSON error body on the response; a Sync API command status is that body already
+        response = getattr(error, 'response', None)
+        if response is not None:
+            try:
+                details = response.json()
+            except ValueError:
+                details = {'error': response.text}
         else:
-            due_date = due_datetime
-            due_date_string = due_datetime.strftime('%Y-%m-%dT%H:%M:%S')
-        
+            details = error
+        return details if isinstance(details, dict) else {'error': str(details)}
+
+    @classmethod
+    def is_unknown_location_error(cls, error):
+        # e.g. {"error": "Invalid argument value", "error_tag": "INVALID_ARGUMENT_VALUE", "error_extra": {"argument": "project_id"}}
+        details = cls.error_details(error)
+        message = ' '.join(str(details.get(key) or '') for key in ('error', 'error_tag', 'error_extra')).lower().replace('_', ' ')
+        return ('project' in message or 'section' in message) and ('not found' in message or 'invalid' in message)
+
+    def is_synced(self, task_name):
+        # Tasks whose last sync attempt failed stay in the log with an 'error' and are retried
+        record = self.ledger.get(task_name)
+        return record is not None and 'error' not in record
+
+    def add_task(self, task_name, course_name, due_datetime):
+        due_date, due_date_string = self.parse_due_datetime(due_datetime)
+
         if due_date <= datetime.datetime.now():
             print(f"Skipping '{task_name}' as its due date is in the past.")
+            self.metrics.incr('todoist.skipped_past_due')
             return
 
-        if self.project_id is None:
-            self.project_id = self.get_project_id(PROJECT_NAME)
-        if self.section_id is None:
-            self.section_id = self.get_section_id(self.project_id, SECTION_NAME)
+        self.resolve_ids()
 
-        tasks_log = self.read_task_log()
-        task_log_names = [task['task_name'] for task in tasks_log]
-
-        if task_name not in task_log_names:
+        if not self.is_synced(task_name):
             try:
-                task = self.api.add_task(
-                    content=task_name,
-                    due_date=due_date,  # Pass datetime object, not string
-                    labels=[course_name],
-                    priority=2,
-                    project_id=self.project_id,
-                    section_id=self.section_id
-                )
-                print(f"Task added to Todoist in {PROJECT_NAME} project under {SECTION_NAME} section: {task.content}")
-
-                tasks_log.append({
+                try:
+                    task = self.create_task(task_name, course_name, due_date)
+                except Exception as e:
+                    if not self.is_unknown_location_error(e):
+                        raise
+                    self.refresh_ids()
+                    task = self.create_task(task_name, course_name, due_date)
+                print(f"Task added to Todoist in {self.project_name} project under {self.section_name} section: {task.content}")
+                self.metrics.incr('todoist.created')
+
+                self.ledger.add(task_name, due_date, {
                     'task_name': task_name,
                     'course_name': course_name,
                     'created_at': datetime.datetime.now().isoformat(),
                     'due_date': due_date_string
                 })
-                self.write_task_log(tasks_log)
             except Exception as e:
                 print(f"An error occurred while adding the task: {e}")
+                self.failures.record()
                 import traceback
                 traceback.print_exc()
         else:
             print(f"Task '{task_name}' already exists in Todoist. No new task created.")
+            self.metrics.incr('todoist.duplicate')
 
-    def clean_task_log(self):
-        tasks_log = self.read_task_log()
-        current_time = datetime.datetime.now()
-        filtered_log = [task for task in tasks_log if datetime.datetime.strptime(task['due_date'], '%Y-%m-%dT%H:%M:%S') > current_time]
+    def create_task(self, task_name, course_name, due_date):
+        self.metrics.incr('api_calls.todoist.tasks.add')
+        with self.metrics.timer('todoist.write'):
+            return self.scheduler.call('todoist', lambda: self.api.add_task(
+                content=task_name,
+                due_date=due_date,  # Pass datetime object, not string
+                labels=[course_name],
+                priority=2,
+                project_id=self.project_id,
+                section_id=self.section_id
+            ), idempotent=False)
+
+    def build_add_command(self, task_name, course_name, due_datetime):
+        due_date, due_date_string = self.parse_due_datetime(due_datetime)
+
+        if due_date <= datetime.datetime.now():
+            print(f"Skipping '{task_name}' as its due date is in the past.")
+            self.metrics.incr('todoist.skipped_past_due')
+            return None
+        if self.is_synced(task_name):
+            print(f"Task '{task_name}' already exists in Todoist. No new task created.")
+            self.metrics.incr('todoist.duplicate')
+            return None
+
+        return self.item_add_command(task_name, course_name, due_date_string)
+
+    def item_add_command(self, task_name, course_name, due_date_string):
+        return {
+            'type': 'item_add',
+            'uuid': str(uuid.uuid4()),
+            'temp_id': str(uuid.uuid4()),
+            'args': {
+                'content': task_name,
+                'due': {'date': due_date_string},
+                'labels': [course_name],
+                'priority': 2,
+                'project_id': self.project_id,
+                'section_id': self.section_id
+            }
+        }
+
+    def item_update_command(self, item_id, task_name, course_name, due_date_string):
+        # content and labels are sent unchanged so send_commands can record the task in the ledger
+        return {
+            'type': 'item_update',
+            'uuid': str(uuid.uuid4()),
+            'args': {
+                'id': item_id,
+                'content': task_name,
+                'due': {'date': due_date_string},
+                'labels': [course_name]
+            }
+        }
+
+    @staticmethod
+    def item_close_command(item_id):
+        return {'type': 'item_close', 'uuid': str(uuid.uuid4()), 'args': {'id': item_id}}
+
+    def post_commands(self, commands):
+        with self.metrics.timer('todoist.write'):
+            return self.post_sync({'commands': json.dumps(commands)})
+
+    def post_sync(self, data):
+        self.metrics.incr('api_calls.todoist.sync')
+
+        def request():
+            response = requests.post(
+                self.sync_url,
+                headers={'Authorization': f'Bearer {self.api_token}'},
+                data=data,
+                timeout=30
+            )
+            response.raise_for_status()
+            return response.json()
+
+        # Todoist applies each command uuid once, so a resent batch of commands does not duplicate tasks
+        return self.scheduler.call('todoist', request)
+
+    def fetch_section_items(self):
+        """Returns {(course_name, task_name): item} for the open tasks in our project section"""
+        params = {'project_id': self.project_id, 'section_id': self.section_id, 'limit': 200}
+        return self.get_listing('/tasks', params, 'results', 'api_calls.todoist.tasks.list')
+
+    def fetch_completed_items(self):
+        """Returns {(course_name, task_name): item} for the tasks in our project section completed within COMPLETED_LOOKBACK"""
+        now = datetime.datetime.utcnow()
+        params = {
+            'since': (now - self.COMPLETED_LOOKBACK).strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'until': now.strftime('%Y-%m-%dT%H:%M:%SZ'),
+            'project_id': self.project_id,
+            'section_id': self.section_id,
+            'limit': 200
+        }
+        return self.get_listing('/tasks/completed/by_completion_date', params, 'items', 'api_calls.todoist.tasks.completed')
+
+    def get_listing(self, path, params, results_key, counter):
+        # Follows next_cursor through a paginated REST listing that lives next to the Sync API endpoint
+        url = self.sync_url.rsplit('/', 1)[0] + path
+        params = dict(params)
+        items = {}
+        while True:
+            self.metrics.incr(counter)
+
+            def request():
+                response = requests.get(url, headers={'Authorization': f'Bearer {self.api_token}'}, params=params, timeout=30)
+                response.raise_for_status()
+                return response.json()
+
+            with self.metrics.timer('todoist.read'):
+                result = self.scheduler.call('todoist', request)
+            for item in result.get(results_key, []):
+                labels = item.get('labels') or [None]
+                items[(labels[0], item['content'])] = item
+
+            if not result.get('next_cursor'):
+                return items
+            params['cursor'] = result['next_cursor']
+
+    def is_completed(self, task_name, course_name, completed_items):
+        # Matched on the id recorded when the task was created, or on course + task for tasks made elsewhere
+        if (course_name, task_name) in completed_items:
+            return True
+        record = self.ledger.get(task_name)
+        completed_ids = {item['id'] for item in completed_items.values()}
+        return record is not None and record.get('todoist_id') in completed_ids
+
+    def send_commands(self, commands, retry_stale_ids=True):
+        try:
+            result = self.post_commands(commands)
+        except (requests.RequestException, CircuitOpenError) as e:
+            print(f"An error occurred while sending {len(commands)} tasks to Todoist: {e}")
+            self.failures.record(len(commands))
+            return
+
+        sync_status = result.get('sync_status', {})
+        temp_id_mapping = result.get('temp_id_mapping', {})
+
+        stale_commands = [
+            command for command in commands
+            if sync_status.get(command['uuid']) not in (None, 'ok') and self.is_unknown_location_error(sync_status[command['uuid']])
+        ]
+        if stale_commands and retry_stale_ids:
+            self.refresh_ids()
+            for command in stale_commands:
+                command['uuid'] = str(uuid.uuid4())
+                command['args']['project_id'] = self.project_id
+                command['args']['section_id'] = self.section_id
+            self.send_commands(stale_commands, retry_stale_ids=False)
+            commands = [command for command in commands if command not in stale_commands]
+
+        for command in commands:
+            args = command['args']
+            status = sync_status.get(command['uuid'])
+            if command['type'] == 'item_close':
+                if status == 'ok':
+                    print(f"Closed Todoist task {args['id']}, which is no longer in the assignments.")
+                    self.metrics.incr('todoist.closed')
+                else:
+                    print(f"An error occurred while closing Todoist task {args['id']}: {status}")
+                    self.failures.record()
+                continue
+
+            task_name = args['content']
+            due_date, due_date_string = self.parse_due_datetime(args['due']['date'])
+            record = {
+                'task_name': task_name,
+                'course_name': args['labels'][0],
+                'created_at': datetime.datetime.now().isoformat(),
+                'due_date': due_date_string
+            }
+
+            if status == 'ok' and command['type'] == 'item_update':
+                record['todoist_id'] = args['id']
+                print(f"Due date of Todoist task '{task_name}' updated to {due_date_string}")
+                self.metrics.incr('todoist.updated')
+            elif status == 'ok':
+                record['todoist_id'] = temp_id_mapping.get(command['temp_id'])
+                print(f"Task added to Todoist in {self.project_name} project under {self.section_name} section: {task_name}")
+                self.metrics.incr('todoist.created')
+            else:
+                record['error'] = status if status is not None else 'No status returned for command'
+                print(f"An error occurred while adding the task '{task_name}': {record['error']}")
+                self.failures.record()
+            self.ledger.add(task_name, due_date, record)
+
+    def reconcile(self, assignments):
+        """Diffs the assignments against the section's open tasks, keyed on course + task, and sends only the changes
+
+        Tasks missing remotely are created (including ones deleted in Todoist, but not ones completed
+        there), tasks whose due date changed are updated, and with TODOIST_RECONCILE_CLOSE, open tasks
+        no longer in the assignments are closed.
+        """
+        self.resolve_ids()
+        desired = {}
+        for task_name, course_name, due_datetime in assignments:
+            desired[(course_name, task_name)] = due_datetime
+        remote_items = self.fetch_section_items()
 
-        if len(filtered_log) != len(tasks_log):
-            self.write_task_log(filtered_log)
+        now = datetime.datetime.now()
+        completed_items = None  # Only looked up when some assignment has no open task
+        commands = []
+        for (course_name, task_name), due_datetime in desired.items():
+            due_date, due_date_string = self.parse_due_datetime(due_datetime)
+            if due_date <= now:
+                self.metrics.incr('todoist.skipped_past_due')
+                continue
+
+            item = remote_items.get((course_name, task_name))
+            if item is None:
+                if completed_items is None:
+                    completed_items = self.fetch_completed_items()
+                if self.is_completed(task_name, course_name, completed_items):
+                    # Digests list an assignment until it is due; a task the student finished stays finished
+                    self.metrics.incr('todoist.completed')
+                    continue
+                commands.append(self.item_add_command(task_name, course_name, due_date_string))
+            elif (item.get('due') or {}).get('date') != due_date_string:
+                commands.append(self.item_update_command(item['id'], task_name, course_name, due_date_string))
+            else:
+                self.metrics.incr('todoist.unchanged')
+
+        if TODOIST_RECONCILE_CLOSE:
+            commands.extend(self.item_close_command(item['id']) for key, item in remote_items.items() if key not in desired)
+
+        print(f"Todoist reconcile: {len(desired)} assignments against {len(remote_items)} open tasks, {len(commands)} changes.")
+        for start in range(0, len(commands), self.SYNC_BATCH_SIZE):
+            self.send_commands(commands[start:start + self.SYNC_BATCH_SIZE])
+
+    def clean_task_log(self):
+        if self.ledger.expire(datetime.datetime.now()):
             print("Cleaned up tasks from log file with due dates in the past.")
 
     def sync_tasks(self):
+        self.sync_stream((task_name, course_name, due_datetime) for task_name, (course_name, due_datetime) in self.tasks.items())
+
+    def sync_stream(self, assignments):
+        # Consumes (task_name, course_name, due_datetime) tuples as they are parsed
+        self.failures.reset()
         self.clean_task_log()
-        for task_name, (course_name, due_datetime) in self.tasks.items():
-            # Handle both string and datetime objects
-            if isinstance(due_datetime, datetime.datetime):
-                due_date_string = due_datetime.strftime('%Y-%m-%dT%H:%M:%S')
+        try:
+            if TODOIST_RECONCILE:
+                self.reconcile(assignments)
+            elif not TODOIST_BULK_SYNC:
+                for task_name, course_name, due_datetime in assignments:
+                    self.add_task(task_name, course_name, due_datetime)
             else:
-                due_date_string = due_datetime
-            self.add_task(task_name, course_name, due_date_string)
+                self.bulk_sync(assignments)
+        finally:
+            # Record what was written even when the stream was cut short, so it is not created again next run
+            self.ledger.flush()
+        self.failures.raise_if_any()
+
+    def bulk_sync(self, assignments):
+        # Bulk mode sends item_add commands through the Sync API, up to SYNC_BATCH_SIZE per request
+        self.resolve_ids()
+        pending_commands = {}  # task name -> latest command, so a re-emitted task is not added twice
+        for task_name, course_name, due_datetime in assignments:
+            command = self.build_add_command(task_name, course_name, due_datetime)
+            if command is not None:
+                pending_commands[task_name] = command
+            if len(pending_commands) == self.SYNC_BATCH_SIZE:
+                self.send_commands(list(pending_commands.values()))
+                pending_commands = {}
+        if pending_commands:
+            self.send_commands(list(pending_commands.values()))
 
 if __name__ == '__main__':
     tasks = {